@@ -1,17 +1,21 @@
 # The code is revised from DiT
 import os
+import json
 import torch
 import torch.nn as nn
 import numpy as np
 import math
 from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
 
 from diffusers.loaders import PeftAdapterMixin
 from timm.models.vision_transformer import PatchEmbed, Attention, Mlp
 from huggingface_hub import snapshot_download
-from safetensors.torch import load_file
+from safetensors import safe_open
+from accelerate import init_empty_weights
 
 from OmniGen.transformer import Phi3Config, Phi3Transformer
+from OmniGen.quantization import quantize_model, load_quantization_config
 
 
 def modulate(x, shift, scale):
@@ -71,8 +75,11 @@ class FinalLayer(nn.Module):
             nn.Linear(hidden_size, 2 * hidden_size, bias=True)
         )
 
-    def forward(self, x, c):
-        shift, scale = self.adaLN_modulation(c).chunk(2, dim=1)
+    def forward(self, x, c, shift_scale=None):
+        "shift_scale: optional precomputed output of `adaLN_modulation(c)`, split into (shift, scale)"
+        if shift_scale is None:
+            shift_scale = self.adaLN_modulation(c).chunk(2, dim=1)
+        shift, scale = shift_scale
         x = modulate(self.norm_final(x), shift, scale)
         x = self.linear(x)
         return x
@@ -185,24 +192,109 @@ class OmniGen(nn.Module, PeftAdapterMixin):
 
         self.llm = Phi3Transformer(config=transformer_config)
         self.llm.config.use_cache = False
+        self.timestep_table = None
+        # contiguous crops of pos_embed per (height, width), they follow the device and dtype of the buffer
+        self.pos_embed_cache = {}
+        # model.safetensors the model was loaded from, which the decoder layers can be streamed from
+        self.checkpoint_path = None
+        # bits and group size of the decoder layers if they are quantized, see OmniGen.quantization
+        self.quantization_config = None
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to()/.half()/.cuda() replace the pos_embed buffer, so the crops of the old one are dropped
+        self.pos_embed_cache = {}
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # loading copies new values into pos_embed
+        self.pos_embed_cache = {}
+        return super()._load_from_state_dict(*args, **kwargs)
     
     @classmethod
-    def from_pretrained(cls, model_name):
+    def from_pretrained(cls, model_name, dtype: torch.dtype = None, stream_layers: bool = False, window: int = 2, num_workers: int = 4):
+        """
+        The model is built on the meta device (no random initialization) and the tensors read from the checkpoint are assigned to it, 
+        so every weight is materialized only once. The shards of a sharded safetensors checkpoint are read by `num_workers` threads.
+        dtype: cast the floating point weights to `dtype` while loading, defaults to `torch.get_default_dtype()` (float32), 
+            the dtype the modules are created with, since the assigned tensors would otherwise keep the storage dtype of the checkpoint
+        stream_layers: don't load the decoder layers, they are read from the memory-mapped model.safetensors during the forward,
+            `window` layers at a time (see `Phi3Transformer.enable_layer_streaming`)
+        A checkpoint saved by `OmniGen.quantization.save_quantized` (with a quantization_config.json) is loaded with quantized decoder layers.
+        """
         if not os.path.exists(model_name):
             cache_folder = os.getenv('HF_HUB_CACHE')
             model_name = snapshot_download(repo_id=model_name,
                                            cache_dir=cache_folder,
                                            ignore_patterns=['flax_model.msgpack', 'rust_model.ot', 'tf_model.h5'])
         config = Phi3Config.from_pretrained(model_name)
-        model = cls(config)
-        if os.path.exists(os.path.join(model_name, 'model.safetensors')):
+        if dtype is None:
+            dtype = torch.get_default_dtype()
+        checkpoint_path = os.path.join(model_name, 'model.safetensors')
+        shard_files = cls.checkpoint_files(model_name)
+        if stream_layers and not os.path.exists(checkpoint_path):
+            raise ValueError(f"Layer streaming needs {checkpoint_path}")
+
+        # buffers (pos_embed, the rotary inv_freq) are still created for real, they are small
+        with init_empty_weights():
+            model = cls(config)
+        quantization_config = load_quantization_config(model_name)
+        if quantization_config is not None:
+            quantize_model(model, empty=True, **quantization_config)
+
+        if len(shard_files) > 0:
             print("Loading safetensors")
-            ckpt = load_file(os.path.join(model_name, 'model.safetensors'))
+            # the decoder layers are read from the checkpoint during the forward when they are streamed
+            ckpt = cls.load_safetensors(shard_files, dtype=dtype, skip_prefix="llm.layers." if stream_layers else None, num_workers=num_workers)
         else:
-            ckpt = torch.load(os.path.join(model_name, 'model.pt'), map_location='cpu')
-        model.load_state_dict(ckpt)
+            ckpt = torch.load(os.path.join(model_name, 'model.pt'), map_location='cpu', mmap=True)
+            ckpt = {k: v.to(dtype) if v.is_floating_point() else v for k, v in ckpt.items()}
+
+        if stream_layers:
+            missing, unexpected = model.load_state_dict(ckpt, strict=False, assign=True)
+            missing = [k for k in missing if not k.startswith("llm.layers.")]
+            if len(missing) > 0 or len(unexpected) > 0:
+                raise RuntimeError(f"Error(s) in loading state_dict: missing keys {missing}, unexpected keys {unexpected}")
+        else:
+            model.load_state_dict(ckpt, assign=True)
+        if os.path.exists(checkpoint_path):
+            model.checkpoint_path = checkpoint_path
+        if stream_layers:
+            model.llm.enable_layer_streaming(checkpoint_path, window=window)
         return model
 
+    @staticmethod
+    def checkpoint_files(model_name):
+        "The safetensors files of the checkpoint, the shards listed in model.safetensors.index.json if it is sharded"
+        index_path = os.path.join(model_name, 'model.safetensors.index.json')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                weight_map = json.load(f)["weight_map"]
+            return [os.path.join(model_name, x) for x in sorted(set(weight_map.values()))]
+        if os.path.exists(os.path.join(model_name, 'model.safetensors')):
+            return [os.path.join(model_name, 'model.safetensors')]
+        return []
+
+    @staticmethod
+    def load_safetensors(files, dtype: torch.dtype = None, skip_prefix: str = None, num_workers: int = 4):
+        "Reads the tensors of the memory-mapped safetensors `files` in parallel, skipping the keys starting with `skip_prefix`"
+        def load_shard(path):
+            state = {}
+            with safe_open(path, framework="pt", device="cpu") as f:
+                for k in f.keys():
+                    if skip_prefix is not None and k.startswith(skip_prefix):
+                        continue
+                    tensor = f.get_tensor(k)
+                    if dtype is not None and tensor.is_floating_point():
+                        tensor = tensor.to(dtype)
+                    state[k] = tensor
+            return state
+
+        ckpt = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(num_workers, len(files)))) as executor:
+            for state in executor.map(load_shard, files):
+                ckpt.update(state)
+        return ckpt
+
     def initialize_weights(self):
         assert not hasattr(self, "llama")
 
@@ -251,6 +343,11 @@ class OmniGen(nn.Module, PeftAdapterMixin):
 
     def cropped_pos_embed(self, height, width):
         """Crops positional embeddings for SD3 compatibility."""
+        if (height, width) not in self.pos_embed_cache:
+            self.pos_embed_cache[(height, width)] = self._crop_pos_embed(height, width).contiguous()
+        return self.pos_embed_cache[(height, width)]
+
+    def _crop_pos_embed(self, height, width):
         if self.pos_embed_max_size is None:
             raise ValueError("`pos_embed_max_size` must be set for cropping.")
 
@@ -274,26 +371,43 @@ class OmniGen(nn.Module, PeftAdapterMixin):
         return spatial_pos_embed
 
 
-    def patch_multiple_resolutions(self, latents, padding_latent=None, is_input_images:bool=False):
+    def patch_multiple_resolutions(self, latents, padding_latent=None, is_input_images:bool=False, embeds_cache:Dict=None):
+        """
+        embeds_cache: optional dict used to embed each latent tensor only once, e.g., an input image shared by several cfg branches or steps.
+            It is keyed by the id of the latent, so the latents must stay alive as long as the dict is used.
+        """
         if isinstance(latents, list):
             return_list = False
             if padding_latent is None:
                 padding_latent = [None] * len(latents)
                 return_list = True
-            patched_latents, num_tokens, shapes = [], [], []
-            for latent, padding in zip(latents, padding_latent):
-                height, width = latent.shape[-2:]
+            # patch embed the latents of the same size in one batch
+            embeds = [None] * len(latents)
+            groups = {}
+            for i, latent in enumerate(latents):
+                if embeds_cache is not None and id(latent) in embeds_cache:
+                    embeds[i] = embeds_cache[id(latent)]
+                else:
+                    groups.setdefault(tuple(latent.shape[-2:]), []).append(i)
+            for (height, width), group in groups.items():
+                batch = torch.cat([latents[i] for i in group], dim=0)
                 if is_input_images:
-                    latent = self.input_x_embedder(latent)
+                    batch = self.input_x_embedder(batch)
                 else:
-                    latent = self.x_embedder(latent)
-                pos_embed = self.cropped_pos_embed(height, width)    
-                latent = latent + pos_embed
-                if padding is not None:
-                    latent = torch.cat([latent, padding], dim=-2)
-                patched_latents.append(latent)
+                    batch = self.x_embedder(batch)
+                batch = batch + self.cropped_pos_embed(height, width)
+                for i, embed in zip(group, batch.split([latents[i].size(0) for i in group], dim=0)):
+                    embeds[i] = embed
+                    if embeds_cache is not None:
+                        embeds_cache[id(latents[i])] = embed
 
-                num_tokens.append(pos_embed.size(1))
+            patched_latents, num_tokens, shapes = [], [], []
+            for latent, embed, padding in zip(latents, embeds, padding_latent):
+                height, width = latent.shape[-2:]
+                num_tokens.append(embed.size(1))
+                if padding is not None:
+                    embed = torch.cat([embed, padding], dim=-2)
+                patched_latents.append(embed)
                 shapes.append([height, width])
             if not return_list:
                 latents = torch.cat(patched_latents, dim=0)
@@ -312,16 +426,23 @@ class OmniGen(nn.Module, PeftAdapterMixin):
         return latents, num_tokens, shapes
 
     
-    def forward(self, x, timestep, input_ids, input_img_latents, input_image_sizes, attention_mask, position_ids, padding_latent=None, past_key_values=None, return_past_key_values=True, offload_model:bool=False):
+    def forward(self, x, timestep, input_ids, input_img_latents, input_image_sizes, attention_mask, position_ids, padding_latent=None, past_key_values=None, return_past_key_values=True, offload_model:bool=False, input_img_embeds_cache:Dict=None):
         """
-        
+        input_img_embeds_cache: optional dict to patch-embed each distinct input image latent only once per generation
         """
         input_is_list = isinstance(x, list)
         x, num_tokens, shapes = self.patch_multiple_resolutions(x, padding_latent)
-        time_token = self.time_token(timestep, dtype=x[0].dtype).unsqueeze(1)   
+        timestep_embeds = self.lookup_timestep_embeddings(timestep, x[0].dtype)
+        if timestep_embeds is not None:
+            time_token, time_emb, shift_scale = timestep_embeds
+        else:
+            time_token = self.time_token(timestep, dtype=x[0].dtype)
+            time_emb, shift_scale = None, None
+        time_token = time_token.unsqueeze(1)
         
-        if input_img_latents is not None:
-            input_latents, _, _ = self.patch_multiple_resolutions(input_img_latents, is_input_images=True)
+        # the input images are only needed when the condition is not read from the kv cache
+        if input_img_latents is not None and input_ids is not None:
+            input_latents, _, _ = self.patch_multiple_resolutions(input_img_latents, is_input_images=True, embeds_cache=input_img_embeds_cache)
         if input_ids is not None:
             condition_embeds = self.llm.embed_tokens(input_ids).clone()
             input_img_inx = 0
@@ -335,12 +456,18 @@ class OmniGen(nn.Module, PeftAdapterMixin):
             input_emb = torch.cat([condition_embeds, time_token, x], dim=1)
         else:
             input_emb = torch.cat([time_token, x], dim=1)
-        output = self.llm(inputs_embeds=input_emb, attention_mask=attention_mask, position_ids=position_ids, past_key_values=past_key_values, offload_model=offload_model)
+        # the grid of the output image tokens, if all rows have the same size (used by the token merging)
+        image_grid = None
+        if not input_is_list or len(set(num_tokens)) == 1:
+            height, width = shapes[0] if input_is_list else shapes
+            image_grid = (height // self.patch_size, width // self.patch_size)
+        output = self.llm(inputs_embeds=input_emb, attention_mask=attention_mask, position_ids=position_ids, past_key_values=past_key_values, offload_model=offload_model, image_grid=image_grid)
         output, past_key_values = output.last_hidden_state, output.past_key_values
         if input_is_list:
             image_embedding = output[:, -max(num_tokens):]
-            time_emb = self.t_embedder(timestep, dtype=x.dtype)
-            x = self.final_layer(image_embedding, time_emb)
+            if time_emb is None:
+                time_emb = self.t_embedder(timestep, dtype=x.dtype)
+            x = self.final_layer(image_embedding, time_emb, shift_scale)
             latents = []
             for i in range(x.size(0)):
                 latent = x[i:i+1, :num_tokens[i]]
@@ -348,8 +475,9 @@ class OmniGen(nn.Module, PeftAdapterMixin):
                 latents.append(latent)
         else:
             image_embedding = output[:, -num_tokens:]
-            time_emb = self.t_embedder(timestep, dtype=x.dtype)
-            x = self.final_layer(image_embedding, time_emb)
+            if time_emb is None:
+                time_emb = self.t_embedder(timestep, dtype=x.dtype)
+            x = self.final_layer(image_embedding, time_emb, shift_scale)
             latents = self.unpatchify(x, shapes[0], shapes[1])
 
         if return_past_key_values:
@@ -357,9 +485,85 @@ class OmniGen(nn.Module, PeftAdapterMixin):
         return latents
 
     @torch.no_grad()
-    def forward_with_cfg(self, x, timestep, input_ids, input_img_latents, input_image_sizes, attention_mask, position_ids, cfg_scale, use_img_cfg, img_cfg_scale, past_key_values, use_kv_cache, offload_model):      
+    def precompute_timesteps(self, sigmas, dtype):
+        """
+        Computes the time token, the timestep embedding and the final layer modulation for all the `sigmas` of a schedule in one batched pass,
+        `forward` then looks them up instead of running the embedders at every step. 
+        The embeddings are stored for the float32 values and for the values rounded to `dtype`, since forward_with_separate_cfg casts the timesteps.
+        Call `clear_timesteps()` when the weights change.
+        """
+        device = self.pos_embed.device
+        sigmas = torch.as_tensor(sigmas, dtype=torch.float32)
+        values = torch.unique(torch.cat([sigmas, sigmas.to(dtype).float()])).to(device)
+        time_token = self.time_token(values, dtype=dtype)
+        time_emb = self.t_embedder(values, dtype=dtype)
+        shift, scale = self.final_layer.adaLN_modulation(time_emb).chunk(2, dim=1)
+        self.timestep_table = dict(values=values, dtype=dtype, time_token=time_token, time_emb=time_emb, shift=shift, scale=scale)
+
+    def clear_timesteps(self):
+        self.timestep_table = None
+
+    def lookup_timestep_embeddings(self, timestep, dtype):
+        "Returns the precomputed (time_token, time_emb, (shift, scale)) of the timesteps, or None if some of them are not in the table"
+        table = self.timestep_table
+        if table is None or table["dtype"] != dtype or table["values"].device != timestep.device:
+            return None
+        match = timestep.float()[:, None] == table["values"][None]
+        if not bool(match.any(dim=1).all()):
+            return None
+        inx = match.int().argmax(dim=1)
+        return table["time_token"][inx], table["time_emb"][inx], (table["shift"][inx], table["scale"][inx])
+
+    @torch.no_grad()
+    def forward_with_cfg(self, x, timestep, input_ids, input_img_latents, input_image_sizes, attention_mask, position_ids, cfg_scale, use_img_cfg, img_cfg_scale, past_key_values, use_kv_cache, offload_model, input_img_embeds_cache=None, guidance=None):      
+        """
+        guidance: optional `OmniGenGuidanceSchedule`, which can skip the unconditional branches. Then only the rows of the conditional branch
+            are run, with a view of their rows of the kv cache.
+        """
         self.llm.config.use_cache = use_kv_cache
-        model_out, past_key_values = self.forward(x, timestep, input_ids, input_img_latents, input_image_sizes, attention_mask, position_ids, past_key_values=past_key_values, return_past_key_values=True, offload_model=offload_model)
+        num_branches = 3 if use_img_cfg else 2
+        mode, run_all = ("cfg", True) if guidance is None else guidance.plan(float(timestep[0]))
+        if run_all:
+            if past_key_values is not None and hasattr(past_key_values, "feature_blocks"):
+                # the branches share the kv cache, but each keeps its own feature cache state
+                n = len(x) // num_branches
+                past_key_values.feature_blocks = [(i * n, (i + 1) * n) for i in range(num_branches)]
+            model_out, past_key_values = self.forward(x, timestep, input_ids, input_img_latents, input_image_sizes, attention_mask, position_ids, past_key_values=past_key_values, return_past_key_values=True, offload_model=offload_model, input_img_embeds_cache=input_img_embeds_cache)
+            branch_out = list(torch.split(model_out, len(model_out) // num_branches, dim=0))
+        else:
+            n = len(x) // num_branches
+            input_ids, input_img_latents, input_image_sizes = self.select_condition_rows(n, input_ids, input_img_latents, input_image_sizes)
+            cond_past_key_values = None if past_key_values is None else past_key_values.select_rows(0, n)
+            cond_out, _ = self.forward(x[:n], timestep[:n], input_ids, input_img_latents, input_image_sizes, attention_mask[:n], position_ids[:n], past_key_values=cond_past_key_values, return_past_key_values=True, offload_model=offload_model, input_img_embeds_cache=input_img_embeds_cache)
+            branch_out = [cond_out]
+        return self.apply_guidance(branch_out, mode, guidance, num_branches, cfg_scale, use_img_cfg, img_cfg_scale), past_key_values
+
+    @staticmethod
+    def select_condition_rows(num_rows, input_ids, input_img_latents, input_image_sizes):
+        "Keeps the first `num_rows` rows of the condition inputs, together with their input images"
+        if input_ids is None:
+            return None, None, None
+        latents, image_sizes, img_inx = [], {}, 0
+        for b_inx, spans in input_image_sizes.items():
+            if b_inx < num_rows:
+                image_sizes[b_inx] = spans
+                latents.extend(input_img_latents[img_inx: img_inx+len(spans)])
+            img_inx += len(spans)
+        return input_ids[:num_rows], latents if len(latents) > 0 else None, image_sizes
+
+    def apply_guidance(self, branch_out, mode, guidance, num_branches, cfg_scale, use_img_cfg, img_cfg_scale):
+        "branch_out: the predictions of the branches which ran, [cond, uncond(, img_cond)] or only [cond]"
+        if mode == "cond":
+            return torch.cat([branch_out[0]] * num_branches, dim=0)
+        if mode == "reuse":
+            branch_out = [branch_out[0]] + guidance.uncond_preds
+        elif guidance is not None:
+            guidance.store(branch_out[1:])
+        return self.combine_cfg(torch.cat(branch_out, dim=0), cfg_scale, use_img_cfg, img_cfg_scale)
+
+    @staticmethod
+    def combine_cfg(model_out, cfg_scale, use_img_cfg, img_cfg_scale):
+        "Applies the guidance to the stacked [cond, uncond(, img_cond)] outputs, and returns the guided output repeated for each branch"
         if use_img_cfg:
             cond, uncond, img_cond = torch.split(model_out, len(model_out) // 3, dim=0)
             cond = uncond + img_cfg_scale * (img_cond - uncond) + cfg_scale * (cond - img_cond)
@@ -369,37 +573,30 @@ class OmniGen(nn.Module, PeftAdapterMixin):
             cond = uncond + cfg_scale * (cond - uncond)
             model_out = [cond, cond]
         
-        return torch.cat(model_out, dim=0), past_key_values
+        return torch.cat(model_out, dim=0)
 
 
     @torch.no_grad()
-    def forward_with_separate_cfg(self, x, timestep, input_ids, input_img_latents, input_image_sizes, attention_mask, position_ids, cfg_scale, use_img_cfg, img_cfg_scale, past_key_values, use_kv_cache, offload_model):
+    def forward_with_separate_cfg(self, x, timestep, input_ids, input_img_latents, input_image_sizes, attention_mask, position_ids, cfg_scale, use_img_cfg, img_cfg_scale, past_key_values, use_kv_cache, offload_model, input_img_embeds_cache=None, guidance=None):
+        "guidance: optional `OmniGenGuidanceSchedule`, the skipped branches are not run and keep their kv cache"
         self.llm.config.use_cache = use_kv_cache
         if past_key_values is None:
             past_key_values = [None] * len(attention_mask)
 
+        mode, run_all = ("cfg", True) if guidance is None or len(input_ids) == 1 else guidance.plan(float(timestep[0]))
         x = torch.split(x, len(x) // len(attention_mask), dim=0)
         timestep = timestep.to(x[0].dtype)
         timestep = torch.split(timestep, len(timestep) // len(input_ids), dim=0)
 
-        model_out, pask_key_values = [], []
-        for i in range(len(input_ids)):
-            temp_out, temp_pask_key_values = self.forward(x[i], timestep[i], input_ids[i], input_img_latents[i], input_image_sizes[i], attention_mask[i], position_ids[i], past_key_values=past_key_values[i], return_past_key_values=True, offload_model=offload_model)
+        model_out, pask_key_values = [], list(past_key_values)
+        for i in range(len(input_ids) if run_all else 1):
+            temp_out, temp_pask_key_values = self.forward(x[i], timestep[i], input_ids[i], input_img_latents[i], input_image_sizes[i], attention_mask[i], position_ids[i], past_key_values=past_key_values[i], return_past_key_values=True, offload_model=offload_model, input_img_embeds_cache=input_img_embeds_cache)
             model_out.append(temp_out)
-            pask_key_values.append(temp_pask_key_values)
+            pask_key_values[i] = temp_pask_key_values
 
-        if len(model_out) == 3:
-            cond, uncond, img_cond = model_out
-            cond = uncond + img_cfg_scale * (img_cond - uncond) + cfg_scale * (cond - img_cond)
-            model_out = [cond, cond, cond]
-        elif len(model_out) == 2:
-            cond, uncond = model_out
-            cond = uncond + cfg_scale * (cond - uncond)
-            model_out = [cond, cond]
-        else:
+        if len(input_ids) == 1:
             return model_out[0]
-        
-        return torch.cat(model_out, dim=0), pask_key_values
+        return self.apply_guidance(model_out, mode, guidance, len(input_ids), cfg_scale, use_img_cfg, img_cfg_scale), pask_key_values
 
 
 
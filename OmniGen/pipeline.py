@@ -1,6 +1,7 @@
 import os
+import time
 import inspect
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import gc
 
 from PIL import Image
@@ -9,6 +10,7 @@ import torch
 from huggingface_hub import snapshot_download
 from peft import LoraConfig, PeftModel
 from diffusers.models import AutoencoderKL
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from diffusers.utils import (
     USE_PEFT_BACKEND,
     is_torch_xla_available,
@@ -20,6 +22,10 @@ from diffusers.utils import (
 from safetensors.torch import load_file
 
 from OmniGen import OmniGen, OmniGenProcessor, OmniGenScheduler
+from OmniGen.transformer import OmniGenFeatureCache, OmniGenTokenMerging
+from OmniGen.scheduler import OmniGenPrefixCache, OmniGenCancellationToken, OmniGenGuidanceSchedule
+from OmniGen.quantization import quantize_model, save_quantized
+from OmniGen.utils import OmniGenLatentCache, OmniGenResidency, tiled_vae_encode, tiled_vae_decode
 
 
 logger = logging.get_logger(__name__) 
@@ -69,9 +75,15 @@ class OmniGenPipeline:
         self.vae.eval()
 
         self.model_cpu_offload = False
+        # where the model and the vae currently are, so calls only move what changed
+        self.residency = OmniGenResidency()
+        self.prefix_cache = None
+        self.latent_cache = None
+        self.vae_tiling = None
+        self.step_times = []
 
     @classmethod
-    def from_pretrained(cls, model_name, vae_path: str=None):
+    def from_pretrained(cls, model_name, vae_path: str=None, dtype: torch.dtype=None, stream_layers: bool=False):
         if not os.path.exists(model_name) or (not os.path.exists(os.path.join(model_name, 'model.safetensors')) and model_name == "Shitao/OmniGen-v1"):
             logger.info("Model not found, downloading...")
             cache_folder = os.getenv('HF_HUB_CACHE')
@@ -79,7 +91,7 @@ class OmniGenPipeline:
                                            cache_dir=cache_folder,
                                            ignore_patterns=['flax_model.msgpack', 'rust_model.ot', 'tf_model.h5', 'model.pt'])
             logger.info(f"Downloaded model to {model_name}")
-        model = OmniGen.from_pretrained(model_name)
+        model = OmniGen.from_pretrained(model_name, dtype=dtype, stream_layers=stream_layers)
         processor = OmniGenProcessor.from_pretrained(model_name)
 
         if os.path.exists(os.path.join(model_name, "vae")):
@@ -93,43 +105,331 @@ class OmniGenPipeline:
         return cls(vae, model, processor)
     
     def merge_lora(self, lora_path: str):
+        if self.model.llm.layer_streamer is not None:
+            raise ValueError("Disable layer streaming before merging a LoRA, the streamed layers are not resident and would be read back without the LoRA")
+        # the checkpoint doesn't have the merged weights, so the layers can't be streamed from it anymore
+        self.model.checkpoint_path = None
         model = PeftModel.from_pretrained(self.model, lora_path)
         model.merge_and_unload()
 
         self.model = model
+        self.residency.invalidate("model")
     
     def to(self, device: Union[str, torch.device]):
         if isinstance(device, str):
             device = torch.device(device)
-        self.model.to(device)
-        self.vae.to(device)
+        self.residency.place("model", self.model, device)
+        self.residency.place("vae", self.vae, device)
         self.device = device
 
     def vae_encode(self, x, dtype):
+        return self.sample_latents(self.vae_encode_moments(x), dtype)
+
+    def vae_encode_moments(self, x):
+        if self.vae_tiling is not None:
+            return tiled_vae_encode(self.vae, x, **self.vae_tiling)
+        return self.vae.encode(x).latent_dist.parameters
+
+    def vae_decode(self, z):
+        if self.vae_tiling is not None:
+            return tiled_vae_decode(self.vae, z, **self.vae_tiling)
+        return self.vae.decode(z).sample
+
+    def sample_latents(self, moments, dtype):
+        "Samples from the latent distribution given by the (mean, logvar) moments of the VAE encoder"
+        x = DiagonalGaussianDistribution(moments).sample()
         if self.vae.config.shift_factor is not None:
-            x = self.vae.encode(x).latent_dist.sample()
             x = (x - self.vae.config.shift_factor) * self.vae.config.scaling_factor
         else:
-            x = self.vae.encode(x).latent_dist.sample().mul_(self.vae.config.scaling_factor)
+            x = x.mul_(self.vae.config.scaling_factor)
         x = x.to(dtype)
         return x
+
+    def set_max_input_image_size(self, max_input_image_size: int):
+        "Replaces the processor if its maximum input image size differs, the tokenizations of the previous processor are kept"
+        if max_input_image_size != self.processor.max_image_size:
+            processor = OmniGenProcessor(self.processor.text_tokenizer, max_image_size=max_input_image_size)
+            processor.tokenization_cache = self.processor.tokenization_cache
+            self.processor = processor
+
+    def lookup_input_images(self, input_images, max_input_image_size):
+        """
+        Computes the latent cache key of each input image. The images whose latents are cached are replaced by 
+        empty placeholders of their processed size, so the processor does not decode them.
+        Returns the images for the processor, their keys and the cached moments.
+        """
+        new_input_images, input_image_keys, cached_moments = [], [], {}
+        for images in input_images:
+            if images is None:
+                new_input_images.append(None)
+                input_image_keys.append(None)
+                continue
+            temp_images, temp_keys = [], []
+            for image in images:
+                key = self.latent_cache.make_key(image, max_input_image_size, self.vae)
+                moments = self.latent_cache.get(key)
+                if moments is not None:
+                    cached_moments[key] = moments
+                    image = torch.empty(3, moments.size(-2) * 8, moments.size(-1) * 8, device="meta")
+                temp_images.append(image)
+                temp_keys.append(key)
+            new_input_images.append(temp_images)
+            input_image_keys.append(temp_keys)
+        return new_input_images, input_image_keys, cached_moments
+
+    def encode_input_images(self, pixel_values, image_keys, cached_moments, dtype):
+        """
+        VAE-encodes a flat list of input images. Images with the same key are encoded once and share the same latent tensor.
+        The images without cached latents are grouped by shape and each group is encoded as one batch.
+        """
+        image_keys = [("image", i) if key is None else key for i, key in enumerate(image_keys)]
+        first_inx = {}
+        for i, key in enumerate(image_keys):
+            first_inx.setdefault(key, i)
+
+        all_moments, shape_groups = {}, {}
+        for key, i in first_inx.items():
+            moments = cached_moments.get(key)
+            if moments is None and self.latent_cache is not None:
+                moments = self.latent_cache.get(key)
+            if moments is not None:
+                all_moments[key] = moments
+            else:
+                shape_groups.setdefault(tuple(pixel_values[i].shape), []).append(key)
+
+        for group in shape_groups.values():
+            batch_moments = self.vae_encode_moments(torch.cat([pixel_values[first_inx[key]] for key in group], dim=0).to(self.device))
+            for key, moments in zip(group, batch_moments.split([pixel_values[first_inx[key]].size(0) for key in group], dim=0)):
+                all_moments[key] = moments
+                if self.latent_cache is not None:
+                    self.latent_cache.put(key, moments)
+
+        latents = {key: self.sample_latents(moments.to(self.device), dtype) for key, moments in all_moments.items()}
+        return [latents[key] for key in image_keys]
     
     def move_to_device(self, data):
         if isinstance(data, list):
             return [x.to(self.device) for x in data]
         return data.to(self.device)
 
-    def enable_model_cpu_offload(self):
+    def enable_model_cpu_offload(self, dtype: torch.dtype = None):
+        """
+        Keeps the decoder layers on cpu (the forward moves them to the device one by one) and the vae on cpu between its uses.
+        The other modules of the model stay on the device. Nothing is moved if the pipeline is already offloaded.
+        """
         self.model_cpu_offload = True
-        self.model.to("cpu")
-        self.vae.to("cpu")
-        torch.cuda.empty_cache()  # Clear VRAM
-        gc.collect()  # Run garbage collection to free system RAM
+        moved = self.residency.place("model", self.model, self.device, dtype, mode="offload", move_fn=self.offload_model_layers)
+        moved = self.residency.place("vae", self.vae, "cpu") or moved
+        if moved:
+            torch.cuda.empty_cache()  # Clear VRAM
+            gc.collect()  # Run garbage collection to free system RAM
+
+    @staticmethod
+    def offload_model_layers(model, device, dtype):
+        model.to(dtype)
+        for name, param in model.named_parameters():
+            if 'layers' in name and 'layers.0' not in name:
+                param.data = param.data.cpu()
+            else:
+                param.data = param.data.to(device)
+        for buffer_name, buffer in model.named_buffers():
+            setattr(model, buffer_name, buffer.to(device))
     
-    def disable_model_cpu_offload(self):
+    def disable_model_cpu_offload(self, dtype: torch.dtype = None):
         self.model_cpu_offload = False
-        self.model.to(self.device)
-        self.vae.to(self.device)
+        self.residency.place("model", self.model, self.device, dtype)
+        self.residency.place("vae", self.vae, self.device)
+
+    def enable_layer_streaming(self, window: int = 2):
+        """
+        Frees the weights of the decoder layers and reads each layer from the memory-mapped model.safetensors just before it runs, 
+        with the next `window - 1` layers read ahead by a background thread. The resident memory then scales with `window` instead of the model size, 
+        which also works without a GPU. Replaces offload_model. Load with `OmniGenPipeline.from_pretrained(..., stream_layers=True)` 
+        to never have all the layers in memory at the same time.
+        """
+        if self.model.checkpoint_path is None:
+            raise ValueError("Layer streaming needs the weights of the model to be those of a model.safetensors checkpoint (e.g., not after merge_lora)")
+        self.model.llm.enable_layer_streaming(self.model.checkpoint_path, window=window)
+        gc.collect()
+
+    def disable_layer_streaming(self):
+        self.model.llm.disable_layer_streaming()
+
+    def quantize(self, bits: int = 8, group_size: int = 128):
+        """
+        Replaces the linear layers of the decoder layers with int8 (per output channel) or int4 (per `group_size` input channels) weights,
+        which are dequantized on the fly. This cuts the memory of the backbone by about 2x or 4x. 
+        Save the result with `save_quantized` to skip quantizing at the next start.
+        """
+        quantize_model(self.base_model(), bits=bits, group_size=group_size)
+        self.residency.invalidate("model")
+        # the weights changed in place, so the condition states computed with the old ones are dropped
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+        gc.collect()
+
+    def save_quantized(self, save_dir: str):
+        "Saves the quantized model with the other files of the checkpoint (processor, vae), `OmniGenPipeline.from_pretrained(save_dir)` loads it back"
+        model = self.base_model()
+        source_dir = None if model.checkpoint_path is None else os.path.dirname(model.checkpoint_path)
+        save_quantized(model, save_dir, source_dir=source_dir)
+
+    def base_model(self):
+        "The OmniGen model, `merge_lora` wraps it into a PeftModel"
+        return self.model.get_base_model() if isinstance(self.model, PeftModel) else self.model
+
+    def enable_prefix_cache(self, max_memory: int = 2 * 1024 ** 3):
+        """
+        Keeps the condition kv cache of previous calls (up to `max_memory` bytes), so conditions that were already seen, 
+        e.g., the default negative prompt, skip the prefill step. Only used when use_kv_cache=True.
+        """
+        self.prefix_cache = OmniGenPrefixCache(max_memory=max_memory)
+
+    def disable_prefix_cache(self):
+        self.prefix_cache = None
+
+    def enable_vae_tiling(self, tile_size: int = 512, overlap: int = 64, tile_batch_size: int = 4):
+        """
+        Encodes and decodes images larger than `tile_size` pixels in overlapping tiles, processed `tile_batch_size` at a time,
+        which keeps the peak memory of the VAE bounded for large resolutions. `tile_size` and `overlap` must be multiples of 8.
+        """
+        assert tile_size % 8 == 0 and overlap % 8 == 0, "tile_size and overlap must be multiples of 8"
+        assert overlap < tile_size, "overlap must be smaller than tile_size"
+        self.vae_tiling = dict(tile_size=tile_size, overlap=overlap, tile_batch_size=tile_batch_size)
+
+    def disable_vae_tiling(self):
+        self.vae_tiling = None
+
+    def enable_feature_cache(self, threshold: float = 0.1, max_skips: int = 3):
+        """
+        Reuses the transformer output of the previous step while the change of the first layer's residual stays small (needs use_kv_cache=True, ignored with offload_model=True).
+        A higher `threshold` skips more steps at a higher quality cost. Each cfg branch keeps its own state, and a forward is only skipped if all its branches can skip. The fraction of skipped branch forwards of the last call is in `pipe.model.llm.feature_cache.skip_rate`.
+        """
+        self.model.llm.feature_cache = OmniGenFeatureCache(threshold=threshold, max_skips=max_skips)
+
+    def disable_feature_cache(self):
+        self.model.llm.feature_cache = None
+
+    def enable_token_merging(self, stride: int = 2, start_layer: int = 2, end_layer: int = 30, min_tokens: int = 4096):
+        """
+        Merges each `stride` x `stride` block of output image tokens into one token for the layers [start_layer, end_layer), 
+        which cuts the attention and MLP cost of these layers for images with at least `min_tokens` tokens (4096 tokens is 1024x1024). 
+        Needs use_kv_cache=True, the prefill step is not merged.
+        """
+        self.model.llm.token_merging = OmniGenTokenMerging(stride=stride, start_layer=start_layer, end_layer=end_layer, min_tokens=min_tokens)
+
+    def disable_token_merging(self):
+        self.model.llm.token_merging = None
+
+    def enable_latent_cache(self, max_memory: int = 1024 ** 3, cache_dir: str = None):
+        """
+        Caches the VAE latents of input images by their content, so repeated input images (e.g., editing the same image with different instructions)
+        skip decoding, resizing and VAE encoding. Evicted latents are spilled to `cache_dir` if it is given.
+        """
+        self.latent_cache = OmniGenLatentCache(max_memory=max_memory, cache_dir=cache_dir)
+
+    def disable_latent_cache(self):
+        self.latent_cache = None
+
+    @torch.no_grad()
+    def prepare_inputs(self, prompt: List[str], input_images: List[List[str]] = None, height: int = 1024, width: int = 1024, 
+                       guidance_scale: float = 3, use_img_guidance: bool = True, img_guidance_scale: float = 1.6, max_input_image_size: int = 1024, 
+                       separate_cfg_infer: bool = True, offload_model: bool = False, use_kv_cache: bool = True, 
+                       use_input_image_size_as_output: bool = False, dtype: torch.dtype = torch.bfloat16, seed: Union[int, List[int]] = None):
+        """
+        Processes the prompts and input images, and returns the initial noise (repeated for each cfg branch), 
+        the model kwargs for `forward_with_cfg`/`forward_with_separate_cfg` and the number of extra cfg branches.
+        """
+        input_image_keys, cached_moments = None, {}
+        if input_images is not None and self.latent_cache is not None:
+            input_images, input_image_keys, cached_moments = self.lookup_input_images(input_images, max_input_image_size)
+
+        input_data = self.processor(prompt, input_images, height=height, width=width, use_img_cfg=use_img_guidance, separate_cfg_input=separate_cfg_infer, use_input_image_size_as_output=use_input_image_size_as_output, input_image_keys=input_image_keys)
+
+        num_prompt = len(prompt)
+        num_cfg = 2 if use_img_guidance else 1
+        if use_input_image_size_as_output:
+            if separate_cfg_infer:
+                height, width = input_data['input_pixel_values'][0][0].shape[-2:]
+            else:
+                height, width = input_data['input_pixel_values'][0].shape[-2:]
+        latent_size_h, latent_size_w = height//8, width//8
+
+        if isinstance(seed, (list, tuple)):
+            assert len(seed) == num_prompt, "the number of seeds must match the number of prompts"
+            latents = torch.cat([torch.randn(1, 4, latent_size_h, latent_size_w, device=self.device, 
+                                             generator=None if s is None else torch.Generator(device=self.device).manual_seed(s)) for s in seed], dim=0)
+        else:
+            if seed is not None:
+                generator = torch.Generator(device=self.device).manual_seed(seed)
+            else:
+                generator = None
+            latents = torch.randn(num_prompt, 4, latent_size_h, latent_size_w, device=self.device, generator=generator)
+        latents = torch.cat([latents]*(1+num_cfg), 0).to(dtype)
+
+        if input_images is not None and self.model_cpu_offload: self.residency.place("vae", self.vae, self.device)
+        if separate_cfg_infer:
+            # encode the images of all cfg branches together, then split the latents back per branch
+            all_latents = self.encode_input_images([x for temp in input_data['input_pixel_values'] for x in temp], 
+                                                   [x for temp in input_data['input_image_keys'] for x in temp], cached_moments, dtype)
+            input_img_latents, start_inx = [], 0
+            for temp_pixel_values in input_data['input_pixel_values']:
+                input_img_latents.append(all_latents[start_inx: start_inx+len(temp_pixel_values)])
+                start_inx += len(temp_pixel_values)
+        else:
+            input_img_latents = self.encode_input_images(input_data['input_pixel_values'], input_data['input_image_keys'], cached_moments, dtype)
+        if input_images is not None and self.model_cpu_offload:
+            self.residency.place("vae", self.vae, "cpu")
+            torch.cuda.empty_cache()  # Clear VRAM
+            gc.collect()  # Run garbage collection to free system RAM
+
+        model_kwargs = dict(input_ids=self.move_to_device(input_data['input_ids']), 
+            input_img_latents=input_img_latents, 
+            input_image_sizes=input_data['input_image_sizes'], 
+            attention_mask=self.move_to_device(input_data["attention_mask"]), 
+            position_ids=self.move_to_device(input_data["position_ids"]), 
+            cfg_scale=guidance_scale,
+            img_cfg_scale=img_guidance_scale,
+            use_img_cfg=use_img_guidance,
+            use_kv_cache=use_kv_cache,
+            offload_model=offload_model,
+            input_img_embeds_cache={},
+            )
+        
+        return latents, model_kwargs, num_cfg
+
+    @torch.no_grad()
+    def decode_latents(self, samples, output_type: str = "pil"):
+        "Decodes the denoised latents of the conditional branch into images"
+        self.residency.place("vae", self.vae, self.device)
+        samples = samples.to(torch.float32)
+        if self.vae.config.shift_factor is not None:
+            samples = samples / self.vae.config.scaling_factor + self.vae.config.shift_factor
+        else:
+            samples = samples / self.vae.config.scaling_factor   
+        samples = self.vae_decode(samples)
+
+        if self.model_cpu_offload:
+            self.residency.place("vae", self.vae, "cpu")
+            torch.cuda.empty_cache()  
+            gc.collect()  
+        
+        samples = (samples * 0.5 + 0.5).clamp(0, 1)
+
+        if output_type == "pt":
+            output_images = samples
+        else:
+            output_samples = (samples * 255).to("cpu", dtype=torch.uint8)
+            output_samples = output_samples.permute(0, 2, 3, 1).numpy()
+            output_images = []
+            for i, sample in enumerate(output_samples):
+                output_images.append(Image.fromarray(sample))
+
+        if self.model_cpu_offload:
+            torch.cuda.empty_cache()  # Clear VRAM
+            gc.collect()              # Run garbage collection to free system RAM
+
+        return output_images
 
     @torch.no_grad()
     @replace_example_docstring(EXAMPLE_DOC_STRING)
@@ -140,18 +440,26 @@ class OmniGenPipeline:
         height: int = 1024,
         width: int = 1024,
         num_inference_steps: int = 50,
+        solver: str = "euler",
         guidance_scale: float = 3,
         use_img_guidance: bool = True,
         img_guidance_scale: float = 1.6,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_reuse_steps: int = 0,
         max_input_image_size: int = 1024,
         separate_cfg_infer: bool = True,
         offload_model: bool = False,
         use_kv_cache: bool = True,
         offload_kv_cache: bool = True,
+        preallocate_kv_cache: bool = False,
         use_input_image_size_as_output: bool = False,
         dtype: torch.dtype = torch.bfloat16,
-        seed: int = None,
+        seed: Union[int, List[int]] = None,
         output_type: str = "pil",
+        callback: Optional[Callable[[int, float, torch.Tensor, torch.Tensor], None]] = None,
+        cancel_token: Optional[OmniGenCancellationToken] = None,
+        timeout: Optional[float] = None,
+        on_interrupt: str = "abort",
         ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -167,6 +475,9 @@ class OmniGenPipeline:
                 The width in pixels of the generated image. The number must be a multiple of 16.
             num_inference_steps (`int`, *optional*, defaults to 50):
                 The number of denoising steps. More denoising steps usually lead to a higher quality image at the expense of slower inference.
+            solver (`str`, *optional*, defaults to "euler"):
+                The ODE solver of the denoising loop: "euler", "heun" or "midpoint" (second order, two model evaluations per step), 
+                or "multistep" (DPM-Solver++(2M), second order with one evaluation per step). Each solver has its own timestep schedule, see `OmniGenScheduler`.
             guidance_scale (`float`, *optional*, defaults to 4.0):
                 Guidance scale as defined in [Classifier-Free Diffusion Guidance](https://arxiv.org/abs/2207.12598).
                 `guidance_scale` is defined as `w` of equation 2. of [Imagen
@@ -177,19 +488,39 @@ class OmniGenPipeline:
                 Defined as equation 3 in [Instrucpix2pix](https://arxiv.org/pdf/2211.09800). 
             img_guidance_scale (`float`, *optional*, defaults to 1.6):
                 Defined as equation 3 in [Instrucpix2pix](https://arxiv.org/pdf/2211.09800). 
+            guidance_interval (`Tuple[float, float]`, *optional*):
+                Only apply the guidance while the sigma (from 0 for pure noise to 1 for the image) is in this interval, e.g., (0.1, 0.9). 
+                Outside of it only the conditional branch runs, which makes these steps 2-3 times cheaper.
+            guidance_reuse_steps (`int`, *optional*, defaults to 0):
+                Recompute the unconditional (and image conditional) predictions only once every `guidance_reuse_steps + 1` model evaluations, 
+                and reuse the last ones in between.
             max_input_image_size (`int`, *optional*, defaults to 1024): the maximum size of input image, which will be used to crop the input image to the maximum size
             separate_cfg_infer (`bool`, *optional*, defaults to False):
                 Perform inference on images with different guidance separately; this can save memory when generating images of large size at the expense of slower inference.
             use_kv_cache (`bool`, *optional*, defaults to True): enable kv cache to speed up the inference
-            offload_kv_cache (`bool`, *optional*, defaults to True): offload the cached key and value to cpu, which can save memory but slow down the generation silightly
-            offload_model (`bool`, *optional*, defaults to False): offload the model to cpu, which can save memory but slow down the generation
+            offload_kv_cache (`bool`, *optional*, defaults to True): offload the cached key and value to cpu, which can save memory but slow down the generation silightly. Only used when a GPU is available; on CPU the cache is kept in place
+            preallocate_kv_cache (`bool`, *optional*, defaults to False): preallocate one key/value buffer per layer and write the image tokens into it in place, which avoids concatenating the whole cache at every step. Cannot be combined with offload_kv_cache
+            offload_model (`bool`, *optional*, defaults to False): offload the model to cpu, which can save memory but slow down the generation. Ignored with `enable_layer_streaming`
             use_input_image_size_as_output (bool, defaults to False): whether to use the input image size as the output image size, which can be used for single-image input, e.g., image editing task
-            seed (`int`, *optional*):
-                A random seed for generating output. 
+            seed (`int` or `List[int]`, *optional*):
+                A random seed for generating output. A list gives one seed per prompt (entries can be None), so the result of a prompt does not depend on the other prompts in the batch.
             dtype (`torch.dtype`, *optional*, defaults to `torch.bfloat16`):
                 data type for the model
             output_type (`str`, *optional*, defaults to "pil"):
                 The type of the output image, which can be "pt" or "pil"
+            callback (`Callable`, *optional*):
+                A function called after each denoising step as `callback(step, sigma, latents, denoised)`, with the latents of the conditional branch 
+                and the estimate of the final latents from this step, which shows the image long before the latents do. 
+                `OmniGen.utils.latent_to_rgb(denoised, output_type="pil")` turns them into low resolution previews without running the VAE.
+            cancel_token (`OmniGenCancellationToken`, *optional*):
+                Stops the denoising loop between two steps once `cancel_token.cancel()` is called, e.g., from another thread.
+            timeout (`float`, *optional*):
+                The time budget of the denoising loop in seconds, it stops before a step which would exceed it.
+            on_interrupt (`str`, *optional*, defaults to "abort"):
+                What to do when the generation is cancelled or runs out of time: "abort" frees the kv cache and raises `OmniGen.scheduler.GenerationInterrupted`,
+                "return" decodes the estimate of the final image from the last step. The time of each step is kept in `pipe.step_times` in both cases, 
+                which is overwritten by the next call, time the steps in `callback` when the pipeline is shared.
+                Both are checked before every step, a generation stopped before its first step has nothing to decode and always raises `GenerationInterrupted`.
         Examples:
 
         Returns:
@@ -208,112 +539,57 @@ class OmniGenPipeline:
         
 
         # set model and processor
-        if max_input_image_size != self.processor.max_image_size:
-            self.processor = OmniGenProcessor(self.processor.text_tokenizer, max_image_size=max_input_image_size)
-        self.model.to(dtype)
+        self.set_max_input_image_size(max_input_image_size)
+        if self.model.llm.layer_streamer is not None and offload_model:
+            logger.info("The decoder layers are streamed from the checkpoint, offload_model is ignored")
+            offload_model = False
+        # only casts and moves the model and the vae if the dtype or offload_model changed since the previous call
         if offload_model:
-            self.enable_model_cpu_offload()
+            self.enable_model_cpu_offload(dtype)
         else:
-            self.disable_model_cpu_offload()
+            self.disable_model_cpu_offload(dtype)
 
-        input_data = self.processor(prompt, input_images, height=height, width=width, use_img_cfg=use_img_guidance, separate_cfg_input=separate_cfg_infer, use_input_image_size_as_output=use_input_image_size_as_output)
+        latents, model_kwargs, num_cfg = self.prepare_inputs(prompt, input_images, height=height, width=width, guidance_scale=guidance_scale, 
+                                                             use_img_guidance=use_img_guidance, img_guidance_scale=img_guidance_scale, 
+                                                             max_input_image_size=max_input_image_size, separate_cfg_infer=separate_cfg_infer, 
+                                                             offload_model=offload_model, use_kv_cache=use_kv_cache, 
+                                                             use_input_image_size_as_output=use_input_image_size_as_output, dtype=dtype, seed=seed)
 
-        num_prompt = len(prompt)
-        num_cfg = 2 if use_img_guidance else 1
-        if use_input_image_size_as_output:
-            if separate_cfg_infer:
-                height, width = input_data['input_pixel_values'][0][0].shape[-2:]
-            else:
-                height, width = input_data['input_pixel_values'][0].shape[-2:]
-        latent_size_h, latent_size_w = height//8, width//8
-
-        if seed is not None:
-            generator = torch.Generator(device=self.device).manual_seed(seed)
-        else:
-            generator = None
-        latents = torch.randn(num_prompt, 4, latent_size_h, latent_size_w, device=self.device, generator=generator)
-        latents = torch.cat([latents]*(1+num_cfg), 0).to(dtype)
-
-        if input_images is not None and self.model_cpu_offload: self.vae.to(self.device)
-        input_img_latents = []
-        if separate_cfg_infer:
-            for temp_pixel_values in input_data['input_pixel_values']:
-                temp_input_latents = []
-                for img in temp_pixel_values:
-                    img = self.vae_encode(img.to(self.device), dtype)
-                    temp_input_latents.append(img)
-                input_img_latents.append(temp_input_latents)
-        else:
-            for img in input_data['input_pixel_values']:
-                img = self.vae_encode(img.to(self.device), dtype)
-                input_img_latents.append(img)
-        if input_images is not None and self.model_cpu_offload:
-            self.vae.to('cpu')
-            torch.cuda.empty_cache()  # Clear VRAM
-            gc.collect()  # Run garbage collection to free system RAM
+        if guidance_interval is not None or guidance_reuse_steps > 0:
+            model_kwargs['guidance'] = OmniGenGuidanceSchedule(interval=guidance_interval or (0.0, 1.0), reuse_steps=guidance_reuse_steps)
 
-        model_kwargs = dict(input_ids=self.move_to_device(input_data['input_ids']), 
-            input_img_latents=input_img_latents, 
-            input_image_sizes=input_data['input_image_sizes'], 
-            attention_mask=self.move_to_device(input_data["attention_mask"]), 
-            position_ids=self.move_to_device(input_data["position_ids"]), 
-            cfg_scale=guidance_scale,
-            img_cfg_scale=img_guidance_scale,
-            use_img_cfg=use_img_guidance,
-            use_kv_cache=use_kv_cache,
-            offload_model=offload_model,
-            )
-        
         if separate_cfg_infer:
             func = self.model.forward_with_separate_cfg
         else:
             func = self.model.forward_with_cfg
 
-        if self.model_cpu_offload:
-            for name, param in self.model.named_parameters():
-                if 'layers' in name and 'layers.0' not in name:
-                    param.data = param.data.cpu()
-                else:
-                    param.data = param.data.to(self.device)
-            for buffer_name, buffer in self.model.named_buffers():
-                setattr(self.model, buffer_name, buffer.to(self.device))
         # else:
         #     self.model.to(self.device)
 
-        scheduler = OmniGenScheduler(num_steps=num_inference_steps)
-        samples = scheduler(latents, func, model_kwargs, use_kv_cache=use_kv_cache, offload_kv_cache=offload_kv_cache)
+        if self.prefix_cache is not None:
+            self.prefix_cache.bind(self.model)
+
+        step_callback = None
+        if callback is not None:
+            step_callback = lambda step, sigma, z, x0: callback(step, sigma, z.chunk((1+num_cfg), dim=0)[0], x0.chunk((1+num_cfg), dim=0)[0])
+
+        if self.model.llm.feature_cache is not None:
+            self.model.llm.feature_cache.reset_stats()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        scheduler = OmniGenScheduler(num_steps=num_inference_steps, solver=solver)
+        # the denoising loop only indexes the time embeddings of the schedule
+        self.model.precompute_timesteps(scheduler.get_eval_sigmas(), dtype)
+        try:
+            samples = scheduler(latents, func, model_kwargs, use_kv_cache=use_kv_cache, offload_kv_cache=offload_kv_cache, preallocate_kv_cache=preallocate_kv_cache, prefix_cache=self.prefix_cache, 
+                                callback=step_callback, cancel_token=cancel_token, deadline=deadline, on_interrupt=on_interrupt)
+        except BaseException:
+            # an interrupted forward leaves the offloaded layers wherever it stopped, so they are placed again by the next call
+            if self.model_cpu_offload:
+                self.residency.invalidate("model")
+            raise
+        finally:
+            self.step_times = scheduler.step_times
+            self.model.clear_timesteps()
         samples = samples.chunk((1+num_cfg), dim=0)[0]
 
-        if self.model_cpu_offload:
-            self.model.to('cpu')
-            torch.cuda.empty_cache()  
-            gc.collect()  
-
-        self.vae.to(self.device)
-        samples = samples.to(torch.float32)
-        if self.vae.config.shift_factor is not None:
-            samples = samples / self.vae.config.scaling_factor + self.vae.config.shift_factor
-        else:
-            samples = samples / self.vae.config.scaling_factor   
-        samples = self.vae.decode(samples).sample
-
-        if self.model_cpu_offload:
-            self.vae.to('cpu')
-            torch.cuda.empty_cache()  
-            gc.collect()  
-        
-        samples = (samples * 0.5 + 0.5).clamp(0, 1)
-
-        if output_type == "pt":
-            output_images = samples
-        else:
-            output_samples = (samples * 255).to("cpu", dtype=torch.uint8)
-            output_samples = output_samples.permute(0, 2, 3, 1).numpy()
-            output_images = []
-            for i, sample in enumerate(output_samples):
-                output_images.append(Image.fromarray(sample))
-
-        torch.cuda.empty_cache()  # Clear VRAM
-        gc.collect()              # Run garbage collection to free system RAM
-
-        return output_images
+        return self.decode_latents(samples, output_type=output_type)
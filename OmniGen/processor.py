@@ -1,6 +1,7 @@
 import os
 import re
 from typing import Dict, List
+from collections import OrderedDict
 import json
 
 import torch
@@ -11,6 +12,7 @@ from torchvision import transforms
 from transformers import AutoTokenizer
 from huggingface_hub import snapshot_download
 
+from OmniGen.transformer import OmniGenAttentionMask
 from OmniGen.utils import (
     create_logger,
     update_ema,
@@ -25,9 +27,12 @@ from OmniGen.utils import (
 class OmniGenProcessor:
     def __init__(self, 
                 text_tokenizer, 
-                max_image_size: int=1024):
+                max_image_size: int=1024,
+                max_cached_tokenizations: int=4096):
         self.text_tokenizer = text_tokenizer
         self.max_image_size = max_image_size
+        self.max_cached_tokenizations = max_cached_tokenizations
+        self.tokenization_cache = OrderedDict()
 
         self.image_transform = transforms.Compose([
             transforms.Lambda(lambda pil_image: crop_arr(pil_image, max_image_size)),
@@ -51,17 +56,49 @@ class OmniGenProcessor:
 
 
     def process_image(self, image):
-        image = Image.open(image).convert('RGB')
-        return self.image_transform(image)
+        if isinstance(image, torch.Tensor):
+            # already processed, e.g., a placeholder for an image whose latent is cached
+            return image
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        return self.image_transform(image.convert('RGB'))
     
-    def process_multi_modal_prompt(self, text, input_images):
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        "Tokenizes `texts`, the texts missing from the LRU cache are sent to the tokenizer in a single batched call"
+        missing_texts = list(dict.fromkeys(x for x in texts if x not in self.tokenization_cache))
+        if len(missing_texts) > 0:
+            for text, input_ids in zip(missing_texts, self.text_tokenizer(missing_texts).input_ids):
+                self.tokenization_cache[text] = tuple(input_ids)
+
+        all_input_ids = []
+        for text in texts:
+            self.tokenization_cache.move_to_end(text)
+            all_input_ids.append(list(self.tokenization_cache[text]))
+        while len(self.tokenization_cache) > self.max_cached_tokenizations:
+            self.tokenization_cache.popitem(last=False)
+        return all_input_ids
+
+    def split_prompt(self, text, has_images: bool):
+        "Returns the chunks of the prompt which are tokenized separately"
         text = self.add_prefix_instruction(text)
+        if not has_images:
+            return [text]
+        return re.split(r"<\|image_\d+\|>", text)
+
+    def image_identity(self, image):
+        "Default key of an input image: its absolute path, or the object itself for images passed in memory"
+        if isinstance(image, str):
+            return os.path.abspath(image)
+        return id(image)
+
+    def process_multi_modal_prompt(self, text, input_images, image_keys=None):
         if input_images is None or len(input_images) == 0:
-            model_inputs = self.text_tokenizer(text)
-            return {"input_ids": model_inputs.input_ids, "pixel_values": None, "image_sizes": None}
+            input_ids = self.tokenize(self.split_prompt(text, has_images=False))[0]
+            return {"input_ids": input_ids, "pixel_values": None, "image_sizes": None, "image_keys": None}
 
         pattern = r"<\|image_\d+\|>"
-        prompt_chunks = [self.text_tokenizer(chunk).input_ids for chunk in re.split(pattern, text)] 
+        prompt_chunks = self.tokenize(self.split_prompt(text, has_images=True))
+        text = self.add_prefix_instruction(text)
 
         for i in range(1, len(prompt_chunks)):
             if prompt_chunks[i][0] == 1:
@@ -76,6 +113,8 @@ class OmniGenProcessor:
         assert len(unique_image_ids) == len(input_images), f"total images must be the same as the number of image tags, got {len(unique_image_ids)} image tags and {len(input_images)} images"
         
         input_images = [input_images[x-1] for x in image_ids]
+        if image_keys is not None:
+            image_keys = [image_keys[x-1] for x in image_ids]
 
         all_input_ids = []
         img_inx = []
@@ -88,8 +127,11 @@ class OmniGenProcessor:
                 img_inx.append([start_inx, start_inx+size])
                 all_input_ids.extend([0]*size)
 
-        return {"input_ids": all_input_ids, "pixel_values": input_images, "image_sizes": img_inx}
+        return {"input_ids": all_input_ids, "pixel_values": input_images, "image_sizes": img_inx, "image_keys": image_keys}
+
 
+    def img_cfg_prompt(self, num_images):
+        return " ".join([f"<img><|image_{i+1}|></img>" for i in range(num_images)])
 
     def add_prefix_instruction(self, prompt):
         user_prompt = '<|user|>\n'
@@ -109,33 +151,64 @@ class OmniGenProcessor:
                 use_img_cfg: bool = True,
                 separate_cfg_input: bool = False,
                 use_input_image_size_as_output: bool=False,
+                input_image_keys: List[List[str]] = None,
                 ) -> Dict:
+        """
+        input_image_keys: optional identifiers of the input images (same layout as `input_images`), by default the image path or object.
+            Images with the same key are processed once, and the keys are passed through to the collated "input_image_keys" 
+            so the pipeline can encode each distinct image once
+        """
 
         if input_images is None:
             use_img_cfg = False
         if isinstance(instructions, str):
             instructions = [instructions]
             input_images = [input_images]
+            if input_image_keys is not None:
+                input_image_keys = [input_image_keys]
+        if input_image_keys is None and input_images is not None:
+            input_image_keys = [None if x is None else [self.image_identity(img) for img in x] for x in input_images]
         
+        # tokenize the chunks of all prompts in one batched call, process_multi_modal_prompt then reads them from the cache
+        all_texts = self.split_prompt(negative_prompt, has_images=False)
+        for i in range(len(instructions)):
+            has_images = input_images is not None and input_images[i] is not None and len(input_images[i]) > 0
+            all_texts.extend(self.split_prompt(instructions[i], has_images))
+            if use_img_cfg and has_images:
+                all_texts.extend(self.split_prompt(self.img_cfg_prompt(len(input_images[i])), has_images=True))
+        self.tokenize(all_texts)
+
+        # the negative prompt is the same for all instructions
+        neg_mllm_input = self.process_multi_modal_prompt(negative_prompt, None)
+
+        # each distinct input image is processed once, even if it is used by several instructions
+        processed_images = {}
         input_data = []
         for i in range(len(instructions)):
             cur_instruction = instructions[i]
             cur_input_images = None if input_images is None else input_images[i]
+            cur_image_keys = None if input_image_keys is None else input_image_keys[i]
             if cur_input_images is not None and len(cur_input_images) > 0:
-                cur_input_images = [self.process_image(x) for x in cur_input_images]
+                temp_images = []
+                for x, key in zip(cur_input_images, cur_image_keys):
+                    if key is None:
+                        temp_images.append(self.process_image(x))
+                        continue
+                    if key not in processed_images:
+                        processed_images[key] = self.process_image(x)
+                    temp_images.append(processed_images[key])
+                cur_input_images = temp_images
             else:
                 cur_input_images = None
                 assert "<img><|image_1|></img>" not in cur_instruction
             
-            mllm_input = self.process_multi_modal_prompt(cur_instruction, cur_input_images)
+            mllm_input = self.process_multi_modal_prompt(cur_instruction, cur_input_images, cur_image_keys)
 
         
-            neg_mllm_input, img_cfg_mllm_input = None, None
-            neg_mllm_input = self.process_multi_modal_prompt(negative_prompt, None)
+            img_cfg_mllm_input = None
             if use_img_cfg:
                 if cur_input_images is not None and len(cur_input_images) >= 1:
-                    img_cfg_prompt = [f"<img><|image_{i+1}|></img>" for i in range(len(cur_input_images))]
-                    img_cfg_mllm_input = self.process_multi_modal_prompt(" ".join(img_cfg_prompt), cur_input_images)
+                    img_cfg_mllm_input = self.process_multi_modal_prompt(self.img_cfg_prompt(len(cur_input_images)), cur_input_images, cur_image_keys)
                 else:
                     img_cfg_mllm_input = neg_mllm_input
 
@@ -166,51 +239,25 @@ class OmniGenCollator:
             position_ids.append(temp_position)
         return torch.LongTensor(position_ids)
     
-    def create_mask(self, attention_mask, num_tokens_for_output_images):
-        extended_mask = []
-        padding_images = []
+    def create_mask(self, attention_mask, num_tokens_for_output_images, image_sizes):
+        """
+        Describes the attention mask by the padding of each row, the input image spans and the output image sizes.
+        The dense (B, L, L) mask is only built by the model, on its device and in its dtype.
+        """
         text_length = attention_mask.size(-1)
-        img_length = max(num_tokens_for_output_images)
-        seq_len = text_length + img_length + 1 # we add a time embedding into the sequence, so add one more token
-        inx = 0
-        for mask in attention_mask:
-            temp_l = torch.sum(mask)
-            pad_l = text_length - temp_l
-
-            temp_mask = torch.tril(torch.ones(size=(temp_l+1, temp_l+1)))
-
-            image_mask = torch.zeros(size=(temp_l+1, img_length))
-            temp_mask = torch.cat([temp_mask, image_mask], dim=-1)
-
-            image_mask = torch.ones(size=(img_length, temp_l+img_length+1))
-            temp_mask = torch.cat([temp_mask, image_mask], dim=0)
-
-            if pad_l > 0:
-                pad_mask = torch.zeros(size=(temp_l+1+img_length, pad_l))
-                temp_mask = torch.cat([pad_mask, temp_mask], dim=-1)
-
-                pad_mask = torch.ones(size=(pad_l, seq_len))
-                temp_mask = torch.cat([pad_mask, temp_mask], dim=0)
+        pad_lengths = text_length - torch.sum(attention_mask, dim=-1)
+        extended_mask = OmniGenAttentionMask(pad_lengths, text_length, num_tokens_for_output_images, image_sizes)
 
-            true_img_length = num_tokens_for_output_images[inx]
+        padding_images = []
+        img_length = max(num_tokens_for_output_images)
+        for true_img_length in num_tokens_for_output_images:
             pad_img_length = img_length - true_img_length
             if pad_img_length > 0:
-                temp_mask[:, -pad_img_length:] = 0
                 temp_padding_imgs = torch.zeros(size=(1, pad_img_length, self.hidden_size))
             else:
                 temp_padding_imgs = None
-            
-            extended_mask.append(temp_mask.unsqueeze(0))
             padding_images.append(temp_padding_imgs)
-            inx += 1
-        return torch.cat(extended_mask, dim=0), padding_images
-    
-    def adjust_attention_for_input_images(self, attention_mask, image_sizes):
-        for b_inx in image_sizes.keys():
-            for start_inx, end_inx in image_sizes[b_inx]:
-                attention_mask[b_inx][start_inx:end_inx, start_inx:end_inx] = 1
-
-        return attention_mask
+        return extended_mask, padding_images
     
     def pad_input_ids(self, input_ids, image_sizes):
         max_l = max([len(x) for x in input_ids])
@@ -243,11 +290,15 @@ class OmniGenCollator:
         for img_size in target_img_size:
             num_tokens_for_output_images.append(img_size[0]*img_size[1]//16//16)
 
-        pixel_values, image_sizes = [], {}
+        pixel_values, image_keys, image_sizes = [], [], {}
         b_inx = 0
         for x in mllm_inputs:
             if x['pixel_values'] is not None:
                 pixel_values.extend(x['pixel_values'])
+                if x.get('image_keys') is not None:
+                    image_keys.extend(x['image_keys'])
+                else:
+                    image_keys.extend([None] * len(x['pixel_values']))
                 for size in x['image_sizes']:
                     if b_inx not in image_sizes:
                         image_sizes[b_inx] = [size]
@@ -260,10 +311,9 @@ class OmniGenCollator:
         input_ids = [x['input_ids'] for x in mllm_inputs]
         padded_input_ids, attention_mask, image_sizes = self.pad_input_ids(input_ids, image_sizes)
         position_ids = self.create_position(attention_mask, num_tokens_for_output_images)
-        attention_mask, padding_images = self.create_mask(attention_mask, num_tokens_for_output_images)
-        attention_mask = self.adjust_attention_for_input_images(attention_mask, image_sizes)
+        attention_mask, padding_images = self.create_mask(attention_mask, num_tokens_for_output_images, image_sizes)
 
-        return padded_input_ids, position_ids, attention_mask, padding_images, pixel_values, image_sizes
+        return padded_input_ids, position_ids, attention_mask, padding_images, pixel_values, image_sizes, image_keys
     
     
     def __call__(self, features):
@@ -281,13 +331,14 @@ class OmniGenCollator:
             target_img_size = target_img_size + target_img_size
 
 
-        all_padded_input_ids, all_position_ids, all_attention_mask, all_padding_images, all_pixel_values, all_image_sizes = self.process_mllm_input(mllm_inputs, target_img_size)
+        all_padded_input_ids, all_position_ids, all_attention_mask, all_padding_images, all_pixel_values, all_image_sizes, all_image_keys = self.process_mllm_input(mllm_inputs, target_img_size)
 
         data = {"input_ids": all_padded_input_ids,
         "attention_mask": all_attention_mask,
         "position_ids": all_position_ids,
         "input_pixel_values": all_pixel_values,
         "input_image_sizes": all_image_sizes,
+        "input_image_keys": all_image_keys,
         "padding_images": all_padding_images,
         }
         return data
@@ -300,39 +351,43 @@ class OmniGenSeparateCollator(OmniGenCollator):
         img_cfg_mllm_input = [f[2] for f in features]
         target_img_size = [f[3] for f in features]
         
-        all_padded_input_ids, all_attention_mask, all_position_ids, all_pixel_values, all_image_sizes, all_padding_images = [], [], [], [], [], []
+        all_padded_input_ids, all_attention_mask, all_position_ids, all_pixel_values, all_image_sizes, all_padding_images, all_image_keys = [], [], [], [], [], [], []
 
 
-        padded_input_ids, position_ids, attention_mask, padding_images, pixel_values, image_sizes = self.process_mllm_input(mllm_inputs, target_img_size)
+        padded_input_ids, position_ids, attention_mask, padding_images, pixel_values, image_sizes, image_keys = self.process_mllm_input(mllm_inputs, target_img_size)
         all_padded_input_ids.append(padded_input_ids)
         all_attention_mask.append(attention_mask)
         all_position_ids.append(position_ids)
         all_pixel_values.append(pixel_values)
         all_image_sizes.append(image_sizes)
         all_padding_images.append(padding_images)
+        all_image_keys.append(image_keys)
 
         if cfg_mllm_inputs[0] is not None:
-            padded_input_ids, position_ids, attention_mask, padding_images, pixel_values, image_sizes = self.process_mllm_input(cfg_mllm_inputs, target_img_size)
+            padded_input_ids, position_ids, attention_mask, padding_images, pixel_values, image_sizes, image_keys = self.process_mllm_input(cfg_mllm_inputs, target_img_size)
             all_padded_input_ids.append(padded_input_ids)
             all_attention_mask.append(attention_mask)
             all_position_ids.append(position_ids)
             all_pixel_values.append(pixel_values)
             all_image_sizes.append(image_sizes)
             all_padding_images.append(padding_images)
+            all_image_keys.append(image_keys)
         if img_cfg_mllm_input[0] is not None:
-            padded_input_ids, position_ids, attention_mask, padding_images, pixel_values, image_sizes = self.process_mllm_input(img_cfg_mllm_input, target_img_size)
+            padded_input_ids, position_ids, attention_mask, padding_images, pixel_values, image_sizes, image_keys = self.process_mllm_input(img_cfg_mllm_input, target_img_size)
             all_padded_input_ids.append(padded_input_ids)
             all_attention_mask.append(attention_mask)
             all_position_ids.append(position_ids)
             all_pixel_values.append(pixel_values)
             all_image_sizes.append(image_sizes)
             all_padding_images.append(padding_images)
+            all_image_keys.append(image_keys)
 
         data = {"input_ids": all_padded_input_ids,
         "attention_mask": all_attention_mask,
         "position_ids": all_position_ids,
         "input_pixel_values": all_pixel_values,
         "input_image_sizes": all_image_sizes,
+        "input_image_keys": all_image_keys,
         "padding_images": all_padding_images,
         }
         return data
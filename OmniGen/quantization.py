@@ -0,0 +1,139 @@
+import os
+import json
+import shutil
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from safetensors.torch import save_file
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+QUANTIZATION_CONFIG_NAME = "quantization_config.json"
+
+
+class QuantizedLinear(nn.Module):
+    """
+    Weight-only quantized replacement of `nn.Linear`, the weight is dequantized on the fly in the forward.
+    bits=8: symmetric per output channel, `qweight` is int8 (out_features, in_features) and `scales` is (out_features,).
+        On CPU the matmul runs on the int8 weight directly with `torch._weight_int8pack_mm` when it is available.
+    bits=4: symmetric per group of `group_size` input channels, two values are packed in each uint8 of `qweight` (out_features, in_features // 2)
+        and `scales` is (out_features, in_features // group_size).
+    The quantized tensors are parameters without grad, so they follow the offloading and the layer streaming like the weights they replace.
+    """
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, bits: int = 8, group_size: int = 128,
+                 device=None, dtype: torch.dtype = torch.float32):
+        super().__init__()
+        assert bits in (4, 8), "only int8 and int4 weights are supported"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        if bits == 8:
+            qweight = torch.empty(out_features, in_features, dtype=torch.int8, device=device)
+            scales = torch.empty(out_features, dtype=dtype, device=device)
+        else:
+            assert in_features % group_size == 0 and group_size % 2 == 0, "in_features must be a multiple of group_size, which must be even"
+            qweight = torch.empty(out_features, in_features // 2, dtype=torch.uint8, device=device)
+            scales = torch.empty(out_features, in_features // group_size, dtype=dtype, device=device)
+        self.qweight = nn.Parameter(qweight, requires_grad=False)
+        self.scales = nn.Parameter(scales, requires_grad=False)
+        self.bias = nn.Parameter(torch.empty(out_features, dtype=dtype, device=device), requires_grad=False) if bias else None
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, bits={self.bits}" + \
+            (f", group_size={self.group_size}" if self.bits == 4 else "")
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int = 8, group_size: int = 128):
+        weight = linear.weight.detach().float()
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, bits=bits, group_size=group_size,
+                     device=weight.device, dtype=linear.weight.dtype)
+        if bits == 8:
+            scales = weight.abs().amax(dim=1).clamp_min(1e-8) / 127
+            qweight = torch.round(weight / scales[:, None]).clamp(-127, 127).to(torch.int8)
+        else:
+            groups = weight.view(weight.size(0), -1, group_size)
+            scales = groups.abs().amax(dim=-1).clamp_min(1e-8) / 7
+            values = torch.round(groups / scales[..., None]).clamp(-8, 7).view(weight.size(0), -1).to(torch.int16) + 8
+            qweight = (values[:, 0::2] | (values[:, 1::2] << 4)).to(torch.uint8)
+        module.qweight.data = qweight
+        module.scales.data = scales.to(linear.weight.dtype)
+        if linear.bias is not None:
+            module.bias.data = linear.bias.detach().clone()
+        return module
+
+    def dequantize(self, dtype: torch.dtype) -> torch.Tensor:
+        if self.bits == 8:
+            return self.qweight.to(dtype) * self.scales.to(dtype)[:, None]
+        values = torch.stack([self.qweight & 0xF, self.qweight >> 4], dim=-1).view(self.out_features, -1, self.group_size)
+        weight = (values.to(dtype) - 8) * self.scales.to(dtype)[..., None]
+        return weight.view(self.out_features, self.in_features)
+
+    def forward(self, x):
+        if self.bits == 8 and x.device.type == "cpu" and hasattr(torch, "_weight_int8pack_mm") and x.dtype in (torch.float32, torch.float16, torch.bfloat16):
+            out = torch._weight_int8pack_mm(x.reshape(-1, self.in_features).contiguous(), self.qweight, self.scales.to(x.dtype))
+            out = out.view(*x.shape[:-1], self.out_features)
+            return out if self.bias is None else out + self.bias.to(x.dtype)
+        return F.linear(x, self.dequantize(x.dtype), None if self.bias is None else self.bias.to(x.dtype))
+
+
+def quantize_model(model: nn.Module, bits: int = 8, group_size: int = 128, empty: bool = False):
+    """
+    Replaces the `nn.Linear` layers of the decoder layers of `model.llm` (attention and MLP projections) with `QuantizedLinear`.
+    The embedders and the final layer of OmniGen are small and stay in full precision.
+    empty: only create the quantized modules on the meta device, for loading a quantized checkpoint
+    """
+    if getattr(model.llm, "layer_streamer", None) is not None:
+        raise ValueError("Disable layer streaming before quantizing, the decoder layers are not resident")
+    for layer in model.llm.layers:
+        for name, module in list(layer.named_modules()):
+            if not isinstance(module, nn.Linear):
+                continue
+            parent_name, _, child_name = name.rpartition(".")
+            parent = layer.get_submodule(parent_name) if parent_name else layer
+            if empty:
+                quantized = QuantizedLinear(module.in_features, module.out_features, bias=module.bias is not None, bits=bits,
+                                            group_size=group_size, device="meta", dtype=module.weight.dtype)
+            else:
+                quantized = QuantizedLinear.from_linear(module, bits=bits, group_size=group_size)
+            setattr(parent, child_name, quantized)
+    model.quantization_config = dict(bits=bits, group_size=group_size)
+    return model
+
+
+def load_quantization_config(model_name: str) -> Optional[dict]:
+    path = os.path.join(model_name, QUANTIZATION_CONFIG_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_quantized(model: nn.Module, save_dir: str, source_dir: str = None):
+    """
+    Saves a quantized OmniGen model as model.safetensors, config.json and quantization_config.json, which `OmniGen.from_pretrained` loads back.
+    The other files of `source_dir` (tokenizer, vae, ...) are copied too, so `save_dir` can be passed to `OmniGenPipeline.from_pretrained`.
+    """
+    if getattr(model, "quantization_config", None) is None:
+        raise ValueError("The model is not quantized, call quantize_model first")
+    if getattr(model.llm, "layer_streamer", None) is not None:
+        raise ValueError("Disable layer streaming before saving, the decoder layers are not resident")
+    os.makedirs(save_dir, exist_ok=True)
+    if source_dir is not None and os.path.abspath(source_dir) != os.path.abspath(save_dir):
+        for name in os.listdir(source_dir):
+            if name.startswith("model.safetensors") or name in ("model.pt", "config.json", QUANTIZATION_CONFIG_NAME):
+                continue
+            src, dst = os.path.join(source_dir, name), os.path.join(save_dir, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst, dirs_exist_ok=True)
+            else:
+                shutil.copy2(src, dst)
+    state_dict = {k: v.detach().contiguous() for k, v in model.state_dict().items()}
+    save_file(state_dict, os.path.join(save_dir, "model.safetensors"))
+    model.llm.config.save_pretrained(save_dir)
+    with open(os.path.join(save_dir, QUANTIZATION_CONFIG_NAME), "w") as f:
+        json.dump(model.quantization_config, f, indent=2)
+    logger.info(f"Saved the quantized model to {save_dir}")
@@ -1,24 +1,42 @@
 from tqdm import tqdm
-from typing import Optional, Dict, Any, Tuple, List
+from typing import Optional, Dict, Any, Tuple, List, Callable
+from collections import OrderedDict, deque
+import copy
+import math
+import itertools
+import threading
+import time
 import gc
 
 import torch
 from transformers.cache_utils import Cache, DynamicCache, OffloadedCache
+from transformers.utils import logging
 
+from OmniGen.transformer import Phi3Transformer
+
+logger = logging.get_logger(__name__)
 
 
 class OmniGenCache(DynamicCache):
     def __init__(self, 
                     num_tokens_for_img: int, offload_kv_cache: bool=False) -> None:
-        if not torch.cuda.is_available():
-            # print("No avaliable GPU, offload_kv_cache wiil be set to False, which will result in large memory usage and time cost when input multiple images!!!")
-            # offload_kv_cache = False
-            raise RuntimeError("OffloadedCache can only be used with a GPU. If there is no GPU, you need to set use_kv_cache=False, which will result in longer inference time!")
         super().__init__()
+        if offload_kv_cache and not torch.cuda.is_available():
+            # the condition cache simply stays on the device it was computed on (e.g. CPU)
+            logger.warning_once("No available GPU, offload_kv_cache will be set to False and the kv cache will be kept on the current device.")
+            offload_kv_cache = False
         self.original_device = []
-        self.prefetch_stream = torch.cuda.Stream()
         self.num_tokens_for_img = num_tokens_for_img
         self.offload_kv_cache = offload_kv_cache
+        # state of the transformer feature cache (see OmniGenFeatureCache) for this cache, and for its row blocks and row views
+        self.feature_state = {}
+        self.row_feature_states = {}
+        # the [start, end) rows of each cfg branch when the cache holds several branches, see feature_states
+        self.feature_blocks = None
+        # set for the first step of a cache seeded from the prefix cache: like in the prefill, all the tokens only attend to the condition
+        self.condition_only = False
+        if self.offload_kv_cache:
+            self.prefetch_stream = torch.cuda.Stream()
 
     def prefetch_layer(self, layer_idx: int):
         "Starts prefetching the next layer cache"
@@ -66,6 +84,39 @@ class OmniGenCache(DynamicCache):
             raise KeyError(f"Cache only has {len(self)} layers, attempted to access layer with index {layer_idx}")
         
        
+    def store_condition(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        "Stores the key and value states of the condition tokens for the layer `layer_idx`"
+         # Update the number of seen tokens
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+            
+        self.key_cache.append(key_states)
+        self.value_cache.append(value_states)
+        self.original_device.append(key_states.device)
+        if self.offload_kv_cache:
+            self.evict_previous_layer(layer_idx)
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def select_rows(self, start: int, end: int):
+        "Returns a cache of the rows [start, end) of this one, e.g., to run only some cfg branches. The states are views, not copies"
+        view = copy.copy(self)
+        view.key_cache = [x[start:end] for x in self.key_cache]
+        view.value_cache = [x[start:end] for x in self.value_cache]
+        view.original_device = list(self.original_device)
+        view.feature_state = self.row_feature_states.setdefault((start, end), {})
+        view.row_feature_states = {}
+        view.feature_blocks = None
+        return view
+
+    def feature_states(self, batch_size: int):
+        """
+        Returns the (start, end, state) of each row block which keeps its own feature cache state, one block per cfg branch. 
+        A block has the same state as the `select_rows` view of its rows, so a branch keeps its state when it runs alone.
+        """
+        if self.feature_blocks is None:
+            return [(0, batch_size, self.feature_state)]
+        return [(start, end, self.row_feature_states.setdefault((start, end), {})) for start, end in self.feature_blocks]
+
     def update(
         self,
         key_states: torch.Tensor, 
@@ -94,17 +145,9 @@ class OmniGenCache(DynamicCache):
             # only cache the states for condition tokens
             key_states = key_states[..., :-(self.num_tokens_for_img+1), :]
             value_states = value_states[..., :-(self.num_tokens_for_img+1), :]
-
-             # Update the number of seen tokens
-            if layer_idx == 0:
-                self._seen_tokens += key_states.shape[-2]
-                
-            self.key_cache.append(key_states)
-            self.value_cache.append(value_states)
-            self.original_device.append(key_states.device)
-            if self.offload_kv_cache:
-                self.evict_previous_layer(layer_idx)
-            return self.key_cache[layer_idx], self.value_cache[layer_idx]
+            return self.store_condition(key_states, value_states, layer_idx)
+        elif self.condition_only:
+            return self[layer_idx]
         else:
             # only cache the states for condition tokens
             key_tensor, value_tensor = self[layer_idx]
@@ -114,14 +157,227 @@ class OmniGenCache(DynamicCache):
 
 
 
+class OmniGenStaticCache(OmniGenCache):
+    """
+    Condition cache with one preallocated key/value buffer per layer, sized for the condition tokens plus the image and time tokens.
+    The states of the image and time tokens are written into the tail of the buffer in place at each step, 
+    so the steady-state denoising loop does not allocate a new `torch.cat` result for every layer.
+    """
+    def __init__(self, 
+                    num_tokens_for_img: int, offload_kv_cache: bool=False) -> None:
+        if offload_kv_cache:
+            logger.warning_once("offload_kv_cache is not supported together with preallocated kv buffers, it will be set to False.")
+        super().__init__(num_tokens_for_img, offload_kv_cache=False)
+        self.key_buffer = []
+        self.value_buffer = []
+
+    def store_condition(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        "Allocates the buffers of the layer `layer_idx` and copies the condition states into their head"
+        condition_length = key_states.shape[-2]
+        buffer_length = condition_length + self.num_tokens_for_img + 1
+        key_buffer = key_states.new_empty(key_states.shape[:-2] + (buffer_length, key_states.shape[-1]))
+        value_buffer = value_states.new_empty(value_states.shape[:-2] + (buffer_length, value_states.shape[-1]))
+        key_buffer[..., :condition_length, :].copy_(key_states)
+        value_buffer[..., :condition_length, :].copy_(value_states)
+        self.key_buffer.append(key_buffer)
+        self.value_buffer.append(value_buffer)
+        # key_cache/value_cache only hold views of the condition part, so the seq length of the cache is unchanged
+        return super().store_condition(key_buffer[..., :condition_length, :], value_buffer[..., :condition_length, :], layer_idx)
+
+    def select_rows(self, start: int, end: int):
+        view = super().select_rows(start, end)
+        view.key_buffer = [x[start:end] for x in self.key_buffer]
+        view.value_buffer = [x[start:end] for x in self.value_buffer]
+        return view
+
+    def update(
+        self,
+        key_states: torch.Tensor, 
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if len(self.key_cache) <= layer_idx or self.condition_only:
+            return super().update(key_states, value_states, layer_idx, cache_kwargs)
+        condition_length = self.key_cache[layer_idx].shape[-2]
+        key_buffer, value_buffer = self.key_buffer[layer_idx], self.value_buffer[layer_idx]
+        if key_states.shape[-2] != key_buffer.shape[-2] - condition_length:
+            # fewer tokens than the buffer was sized for (e.g., merged image tokens)
+            return torch.cat([self.key_cache[layer_idx], key_states], dim=-2), torch.cat([self.value_cache[layer_idx], value_states], dim=-2)
+        key_buffer[..., condition_length:, :].copy_(key_states)
+        value_buffer[..., condition_length:, :].copy_(value_states)
+        return key_buffer, value_buffer
+
+
+
+class OmniGenPrefixCache:
+    """
+    LRU cache of the condition key/value states of previous generations, shared across requests. 
+    Entries are keyed by the token ids of a condition, the dtype, the model and whether LongRoPE used its long factors. The factors are picked by the padded kv length
+    of the whole batch (padded condition + time token + image tokens), so the same condition is stored separately for short and long batches.
+    The condition tokens only attend to the condition, so the states don't depend on anything else.
+    It seeds `OmniGenCache`, so a batch whose conditions have all been seen before (e.g., the default negative prompt) skips the prefill step.
+    Conditions with input images are not cached. The stored states take at most `max_memory` bytes.
+    """
+    def __init__(self, max_memory: int = 2 * 1024 ** 3):
+        self.max_memory = max_memory
+        self.memory = 0
+        self.entries = OrderedDict()
+        self.model_id = None
+        # LongRoPE switches to its long factors above this kv length, None if the model has no rope scaling
+        self.long_rope_threshold = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def bind(self, model):
+        "Sets the model the states belong to, the states of another model are dropped"
+        if self.model_id != id(model):
+            self.clear()
+            self.model_id = id(model)
+        config = model.llm.config
+        self.long_rope_threshold = config.original_max_position_embeddings if getattr(config, "rope_scaling", None) is not None else None
+
+    def uses_long_rope(self, kv_length: int) -> bool:
+        return self.long_rope_threshold is not None and kv_length > self.long_rope_threshold
+
+    def clear(self):
+        self.entries.clear()
+        self.memory = 0
+
+    def get(self, token_ids: Tuple[int], kv_length: int, dtype: torch.dtype):
+        "kv_length: the padded kv length of the batch the states are used in"
+        key = (self.model_id, self.uses_long_rope(kv_length), str(dtype), token_ids)
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][:2]
+
+    def put(self, token_ids: Tuple[int], kv_length: int, dtype: torch.dtype, key_states: List[torch.Tensor], value_states: List[torch.Tensor]):
+        "kv_length: the padded kv length of the batch the states were computed in"
+        key = (self.model_id, self.uses_long_rope(kv_length), str(dtype), token_ids)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        size = sum(x.numel() * x.element_size() for x in key_states + value_states)
+        if size > self.max_memory:
+            return
+        while self.memory + size > self.max_memory:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.memory -= evicted_size
+        self.entries[key] = (key_states, value_states, size)
+        self.memory += size
+
+
+
+class OmniGenCancellationToken:
+    "Thread-safe flag to stop a running generation between two steps, e.g., when the client went away"
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+
+class GenerationInterrupted(RuntimeError):
+    pass
+
+
+class OmniGenGuidanceSchedule:
+    """
+    Decides which cfg branches run at each model evaluation (passed as `guidance` to `forward_with_cfg`/`forward_with_separate_cfg`).
+    Args:
+        interval: (min, max) of the sigmas (0 is pure noise, 1 is the image) where guidance is applied, 
+            outside of it only the conditional branch runs and its prediction is used as is
+        reuse_steps: inside the interval, the predictions of the unconditional (and image conditional) branches are recomputed 
+            once every `reuse_steps + 1` evaluations and reused in between, only the conditional branch runs in the reuse evaluations
+    The first evaluation always runs all the branches, since it fills their kv caches. 
+    Skipped branches keep their condition cache untouched, so they can run again at any later evaluation.
+    """
+    def __init__(self, interval: Tuple[float, float] = (0.0, 1.0), reuse_steps: int = 0):
+        self.interval = interval
+        self.reuse_steps = reuse_steps
+        self.reset()
+
+    def reset(self):
+        self.num_evals = 0
+        self.num_skipped = 0
+        self.uncond_preds = None
+        self.since_refresh = 0
+
+    def plan(self, sigma: float):
+        """
+        Returns the guidance mode of the next evaluation ("cfg", "reuse" or "cond") and whether all the branches have to run:
+        "cfg" applies the guidance with fresh predictions, "reuse" with the stored ones, and "cond" uses the conditional prediction only.
+        """
+        self.num_evals += 1
+        if not (self.interval[0] <= sigma <= self.interval[1]):
+            mode = "cond"
+            self.uncond_preds = None
+        elif self.uncond_preds is not None and self.since_refresh < self.reuse_steps:
+            mode = "reuse"
+            self.since_refresh += 1
+        else:
+            mode = "cfg"
+        run_all = mode == "cfg" or self.num_evals == 1
+        if not run_all:
+            self.num_skipped += 1
+        return mode, run_all
+
+    def store(self, uncond_preds: List[torch.Tensor]):
+        "Keeps the predictions of the other branches for the next reuse evaluations"
+        if self.reuse_steps > 0:
+            self.uncond_preds = uncond_preds
+            self.since_refresh = 0
+
+
+
 class OmniGenScheduler:
-    def __init__(self, num_steps: int=50, time_shifting_factor: int=1):
+    # number of model evaluations per step of each solver
+    solvers = {"euler": 1, "heun": 2, "midpoint": 2, "multistep": 1}
+    # timestep schedule of each solver, see get_sigmas
+    schedules = {"euler": "uniform", "heun": "uniform", "midpoint": "uniform", "multistep": "logsnr"}
+
+    def __init__(self, num_steps: int=50, time_shifting_factor: int=1, solver: str="euler"):
+        """
+        solver: "euler" (the default), "heun" or "midpoint" (second order, two model evaluations per step, the last heun step is an euler step), 
+            or "multistep" (DPM-Solver++(2M) on the data prediction, one evaluation per step, on a grid uniform in log-SNR). 
+        """
+        assert solver in self.solvers, f"solver should be one of {list(self.solvers)}, got {solver}"
         self.num_steps = num_steps
         self.time_shift = time_shifting_factor
+        self.solver = solver
+        self.sigma = self.get_sigmas(num_steps, time_shifting_factor, schedule=self.schedules[solver])
+        # the wall-clock seconds of each step of the last call, and whether it was stopped early
+        self.step_times = []
+        self.interrupted = False
+        self.num_evals = 0
 
+    @staticmethod
+    def get_sigmas(num_steps: int, time_shifting_factor: int=1, schedule: str="uniform"):
+        """
+        schedule: "uniform" is the shifted uniform grid. "logsnr" keeps its first two and last two sigmas 
+            and spaces the ones in between uniformly in log-SNR, log(sigma / (1 - sigma)), the time variable of the multistep solver.
+        """
         t = torch.linspace(0, 1, num_steps+1)
         t = t / (t + time_shifting_factor - time_shifting_factor * t)
-        self.sigma = t
+        if schedule == "logsnr" and num_steps > 3:
+            log_snr = torch.logit(t[1:-1].double())
+            t[1:-1] = torch.sigmoid(torch.linspace(float(log_snr[0]), float(log_snr[-1]), num_steps-1, dtype=torch.float64)).float()
+        return t
+
+    @staticmethod
+    def log_snr(sigma: float) -> float:
+        "Log signal-to-noise ratio of z = sigma * x + (1 - sigma) * noise, for 0 < sigma < 1"
+        return math.log(sigma) - math.log1p(-sigma)
     
     def crop_kv_cache(self, past_key_values, num_tokens_for_img):
         # return 
@@ -141,9 +397,107 @@ class OmniGenScheduler:
         return position_ids
 
     def crop_attention_mask_for_cache(self, attention_mask, num_tokens_for_img):
+        # make the cropped mask contiguous so the full mask of the first step can be released
+        if isinstance(attention_mask, list):
+            return [x[..., -(num_tokens_for_img+1):, :].contiguous() for x in attention_mask]
+        return attention_mask[..., -(num_tokens_for_img+1):, :].contiguous()
+
+    def prepare_attention_mask(self, attention_mask, dtype, device=None):
         if isinstance(attention_mask, list):
-            return [x[..., -(num_tokens_for_img+1):, :] for x in attention_mask]
-        return attention_mask[..., -(num_tokens_for_img+1):, :]
+            return [Phi3Transformer.prepare_attention_mask(x, dtype, device) for x in attention_mask]
+        return Phi3Transformer.prepare_attention_mask(attention_mask, dtype, device)
+
+    def crop_inputs_for_cache(self, model_kwargs, num_tokens_for_img, branches):
+        "Drops the condition tokens of the given cfg branches from the inputs, their key and value states are read from the kv cache"
+        if not isinstance(model_kwargs['input_ids'], list):
+            if len(branches) > 0:
+                model_kwargs['input_ids'] = None
+                model_kwargs['position_ids'] = self.crop_position_ids_for_cache(model_kwargs['position_ids'], num_tokens_for_img)
+                model_kwargs['attention_mask'] = self.crop_attention_mask_for_cache(model_kwargs['attention_mask'], num_tokens_for_img)
+            return
+        input_ids, position_ids, attention_mask = list(model_kwargs['input_ids']), list(model_kwargs['position_ids']), list(model_kwargs['attention_mask'])
+        for b_inx in branches:
+            input_ids[b_inx] = None
+            position_ids[b_inx] = self.crop_position_ids_for_cache(position_ids[b_inx], num_tokens_for_img)
+            attention_mask[b_inx] = self.crop_attention_mask_for_cache(attention_mask[b_inx], num_tokens_for_img)
+        model_kwargs['input_ids'], model_kwargs['position_ids'], model_kwargs['attention_mask'] = input_ids, position_ids, attention_mask
+
+    def get_prefix_keys(self, input_ids, position_ids, input_image_sizes):
+        "Returns the (unpadded) condition token ids of each row, or None for the rows with input images"
+        text_length = input_ids.size(-1)
+        pad_lengths = (text_length - 1 - position_ids[:, text_length-1]).tolist()
+        prefix_keys = []
+        for b_inx, ids in enumerate(input_ids.tolist()):
+            if b_inx in input_image_sizes:
+                prefix_keys.append(None)
+            else:
+                prefix_keys.append(tuple(ids[pad_lengths[b_inx]:]))
+        return prefix_keys
+
+    def seed_cache_from_prefix(self, cache, model_kwargs, prefix_cache, num_tokens_for_img, dtype, device):
+        """
+        Fills the kv cache of each cfg branch from `prefix_cache` when the conditions of all its rows are found.
+        Returns the condition token ids of each branch and whether each branch was filled.
+        """
+        is_list = isinstance(cache, list)
+        caches = cache if is_list else [cache]
+        input_ids = model_kwargs['input_ids'] if is_list else [model_kwargs['input_ids']]
+        position_ids = model_kwargs['position_ids'] if is_list else [model_kwargs['position_ids']]
+        input_image_sizes = model_kwargs['input_image_sizes'] if is_list else [model_kwargs['input_image_sizes']]
+
+        prefix_keys, prefilled = [], []
+        for b_inx in range(len(caches)):
+            row_keys = self.get_prefix_keys(input_ids[b_inx], position_ids[b_inx], input_image_sizes[b_inx])
+            prefix_keys.append(row_keys)
+            text_length = input_ids[b_inx].size(-1)
+            kv_length = text_length + num_tokens_for_img + 1
+            entries = [None] if None in row_keys else [prefix_cache.get(x, kv_length, dtype) for x in row_keys]
+            if any(x is None for x in entries):
+                prefilled.append(False)
+                continue
+
+            for layer_idx in range(len(entries[0][0])):
+                # left pad each row to the length of the batch, the padding is masked out by the attention mask
+                key_states = torch.cat([torch.nn.functional.pad(x[0][layer_idx], (0, 0, text_length - x[0][layer_idx].size(-2), 0)).to(device) for x in entries], dim=0)
+                value_states = torch.cat([torch.nn.functional.pad(x[1][layer_idx], (0, 0, text_length - x[1][layer_idx].size(-2), 0)).to(device) for x in entries], dim=0)
+                caches[b_inx].store_condition(key_states, value_states, layer_idx)
+            # the first step still has the attention of the prefill, so a hit gives the same image as a miss
+            caches[b_inx].condition_only = True
+            prefilled.append(True)
+        return prefix_keys, prefilled
+
+    def store_prefix(self, cache, prefix_keys, prefilled, prefix_cache, num_tokens_for_img, dtype):
+        "Saves the condition states of the rows computed in the prefill step into `prefix_cache`"
+        caches = cache if isinstance(cache, list) else [cache]
+        for b_inx in range(len(caches)):
+            if prefilled[b_inx]:
+                continue
+            text_length = caches[b_inx].key_cache[0].size(-2)
+            for row_inx, token_ids in enumerate(prefix_keys[b_inx]):
+                if token_ids is None:
+                    continue
+                start_inx = text_length - len(token_ids)
+                key_states = [x[row_inx:row_inx+1, :, start_inx:, :].clone() for x in caches[b_inx].key_cache]
+                value_states = [x[row_inx:row_inx+1, :, start_inx:, :].clone() for x in caches[b_inx].value_cache]
+                prefix_cache.put(token_ids, text_length + num_tokens_for_img + 1, dtype, key_states, value_states)
+
+    def get_eval_sigmas(self):
+        "All the sigmas the solver evaluates the model at"
+        sigmas = self.sigma[:-1]
+        if self.solver == "heun":
+            # the last step is an euler step
+            sigmas = torch.cat([sigmas, self.sigma[1:-1]])
+        elif self.solver == "midpoint":
+            sigmas = torch.cat([sigmas, (self.sigma[:-1] + self.sigma[1:]) / 2])
+        return sigmas
+
+    def should_stop(self, cancel_token, deadline):
+        if cancel_token is not None and cancel_token.cancelled:
+            return True
+        if deadline is not None:
+            # the first step includes the prefill, so the last step is the better estimate of the next one
+            return time.monotonic() + (self.step_times[-1] if len(self.step_times) > 0 else 0) > deadline
+        return False
 
     def crop_cache(self, cache, num_tokens_for_img):
         for i in range(len(cache.key_cache)):
@@ -152,32 +506,335 @@ class OmniGenScheduler:
         
         return cache
 
-    def __call__(self, z, func, model_kwargs, use_kv_cache: bool=True, offload_kv_cache: bool=True):
+    def __call__(self, z, func, model_kwargs, use_kv_cache: bool=True, offload_kv_cache: bool=True, preallocate_kv_cache: bool=False, prefix_cache: Optional[OmniGenPrefixCache]=None,
+                 callback: Optional[Callable]=None, cancel_token: Optional[OmniGenCancellationToken]=None, deadline: Optional[float]=None, on_interrupt: str="abort"):
+        """
+        callback: called after each step as `callback(step, sigma, z, x0)`, with the index of the step, the sigma reached by the step, the current latents 
+            and the estimate of the final latents `z + (1 - sigma) * v`, which is much closer to the image in the early steps
+        cancel_token: checked between the steps, the generation stops once it is cancelled
+        deadline: `time.monotonic()` value, the generation stops before a step that would (judging by the previous step) finish after it
+        on_interrupt: what to do when the generation is stopped, "abort" frees the kv cache and raises `GenerationInterrupted`, 
+            "return" returns the estimate of the final latents from the last prediction. 
+            A generation stopped before its first step (e.g., cancelled or expired while queued) has no prediction and always raises `GenerationInterrupted`
+        """
+        assert on_interrupt in ("abort", "return"), f"on_interrupt should be 'abort' or 'return', got {on_interrupt}"
+        self.step_times = []
+        self.interrupted = False
         num_tokens_for_img = z.size(-1)*z.size(-2) // 4
+        cache_cls = OmniGenStaticCache if preallocate_kv_cache else OmniGenCache
         if isinstance(model_kwargs['input_ids'], list):
-            cache = [OmniGenCache(num_tokens_for_img, offload_kv_cache) for _ in range(len(model_kwargs['input_ids']))] if use_kv_cache else None
+            cache = [cache_cls(num_tokens_for_img, offload_kv_cache) for _ in range(len(model_kwargs['input_ids']))] if use_kv_cache else None
         else:
-            cache = OmniGenCache(num_tokens_for_img, offload_kv_cache) if use_kv_cache else None
-        results = {}
-        for i in tqdm(range(self.num_steps)):
-            timesteps = torch.zeros(size=(len(z), )).to(z.device) + self.sigma[i]
+            cache = cache_cls(num_tokens_for_img, offload_kv_cache) if use_kv_cache else None
+        num_branches = len(cache) if isinstance(cache, list) else 1
+
+        prefix_keys, prefilled = None, [False] * num_branches
+        if use_kv_cache and prefix_cache is not None:
+            prefix_keys, prefilled = self.seed_cache_from_prefix(cache, model_kwargs, prefix_cache, num_tokens_for_img, z.dtype, z.device)
+
+        # build the additive mask once in the target dtype, it is reused (cropped) by all the steps
+        model_kwargs['attention_mask'] = self.prepare_attention_mask(model_kwargs['attention_mask'], z.dtype, z.device)
+        # the branches seeded from the prefix cache skip the prefill
+        self.crop_inputs_for_cache(model_kwargs, num_tokens_for_img, [b_inx for b_inx in range(num_branches) if prefilled[b_inx]])
+        num_evals = 0
+        def model_fn(z, sigma):
+            nonlocal cache, num_evals
+            timesteps = torch.zeros(size=(len(z), )).to(z.device) + sigma
             pred, cache = func(z, timesteps, past_key_values=cache, **model_kwargs)
-            sigma_next = self.sigma[i+1]
-            sigma = self.sigma[i]
-            z = z + (sigma_next - sigma) * pred
-            if i == 0 and use_kv_cache:
-                num_tokens_for_img = z.size(-1)*z.size(-2) // 4
-                if isinstance(cache, list):
-                    model_kwargs['input_ids'] = [None] * len(cache)
-                else:
-                    model_kwargs['input_ids'] = None
+            if num_evals == 0 and use_kv_cache:
+                # the first evaluation filled the condition cache, the next ones only feed the time and image tokens
+                if prefix_keys is not None:
+                    self.store_prefix(cache, prefix_keys, prefilled, prefix_cache, num_tokens_for_img, z.dtype)
+                    for branch_cache in (cache if isinstance(cache, list) else [cache]):
+                        if branch_cache is not None:
+                            branch_cache.condition_only = False
+                self.crop_inputs_for_cache(model_kwargs, num_tokens_for_img, [b_inx for b_inx in range(num_branches) if not prefilled[b_inx]])
+            num_evals += 1
+            return pred
 
-                model_kwargs['position_ids'] = self.crop_position_ids_for_cache(model_kwargs['position_ids'], num_tokens_for_img)
-                model_kwargs['attention_mask'] = self.crop_attention_mask_for_cache(model_kwargs['attention_mask'], num_tokens_for_img)
+        solver_step = getattr(self, f"{self.solver}_step")
+        solver_state = {}
+        for i in tqdm(range(self.num_steps)):
+            # also checked before the first step, which is the most expensive one with the prefill
+            if self.should_stop(cancel_token, deadline):
+                self.interrupted = True
+                if on_interrupt == "abort" or i == 0:
+                    del cache
+                    solver_state.clear()
+                    torch.cuda.empty_cache()
+                    gc.collect()
+                    raise GenerationInterrupted(f"The generation was stopped after {i} of {self.num_steps} steps")
+                # the velocity points from the noise to the data, so the data estimate is z + (1 - sigma) * v
+                z = z + (1 - self.sigma[i]) * pred
+                break
+
+            start_time = time.monotonic()
+            z, pred = solver_step(model_fn, z, i, solver_state)
+            if z.is_cuda:
+                torch.cuda.synchronize(z.device)
+            self.step_times.append(time.monotonic() - start_time)
+            if callback is not None:
+                sigma_next = self.sigma[i+1].item()
+                callback(i, sigma_next, z, z + (1 - sigma_next) * pred)
 
-        del cache
-        torch.cuda.empty_cache()  
-        gc.collect()
+        self.num_evals = num_evals
+        # the freed kv cache stays in the allocator for the next call, the pipeline empties the caches when it offloads
+        del cache, solver_state
         return z
 
-    
\ No newline at end of file
+    def euler_step(self, model_fn, z, i, state):
+        "Returns the next latents and the velocity used for the step"
+        sigma, sigma_next = self.sigma[i], self.sigma[i+1]
+        pred = model_fn(z, sigma)
+        return z + (sigma_next - sigma) * pred, pred
+
+    def heun_step(self, model_fn, z, i, state):
+        """
+        Trapezoidal rule: averages the velocities at both ends of an Euler step (2 evaluations per step).
+        The last step is a plain Euler step, as the model is not evaluated at sigma=1.
+        """
+        sigma, sigma_next = self.sigma[i], self.sigma[i+1]
+        pred = model_fn(z, sigma)
+        if i == self.num_steps - 1:
+            return z + (sigma_next - sigma) * pred, pred
+        pred_next = model_fn(z + (sigma_next - sigma) * pred, sigma_next)
+        pred = (pred + pred_next) / 2
+        return z + (sigma_next - sigma) * pred, pred
+
+    def midpoint_step(self, model_fn, z, i, state):
+        "Uses the velocity at the middle of the step (2 evaluations per step)"
+        sigma, sigma_next = self.sigma[i], self.sigma[i+1]
+        h = sigma_next - sigma
+        pred = model_fn(z, sigma)
+        # same expression as get_eval_sigmas, so the precomputed time embeddings are found
+        pred = model_fn(z + h / 2 * pred, (sigma + sigma_next) / 2)
+        return z + h * pred, pred
+
+    def multistep_step(self, model_fn, z, i, state):
+        """
+        DPM-Solver++(2M): second order multistep update of the data prediction x0 = z + (1 - sigma) * v in log-SNR time, 
+        reusing the data prediction of the previous step (1 evaluation per step).
+        The first two steps (from pure noise, where the log-SNR is -inf) and the last step (to sigma=1) are first order, which equals an Euler step.
+        """
+        sigma, sigma_next = float(self.sigma[i]), float(self.sigma[i+1])
+        pred = model_fn(z, self.sigma[i])
+        prev = state.get("prev")
+        if sigma <= 0 or sigma_next >= 1:
+            state["prev"] = None
+            return z + (sigma_next - sigma) * pred, pred
+        x0, log_snr = z + (1 - sigma) * pred, self.log_snr(sigma)
+        state["prev"] = (x0, log_snr)
+        if prev is None:
+            return z + (sigma_next - sigma) * pred, pred
+        h, h_prev = self.log_snr(sigma_next) - log_snr, log_snr - prev[1]
+        r = h_prev / h
+        x0 = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * prev[0]
+        z_next = (1 - sigma_next) / (1 - sigma) * z - sigma_next * math.expm1(-h) * x0
+        # the velocity of the step, used like the one of the other solvers (e.g., by on_interrupt="return")
+        return z_next, (z_next - z) / (sigma_next - sigma)
+
+    
+
+
+
+class OmniGenGeneration:
+    "State of one in-flight generation of `OmniGenContinuousScheduler`"
+    _ids = itertools.count()
+
+    def __init__(self, z, model_kwargs, sigma, user_data=None):
+        self.id = next(self._ids)
+        self.z = z
+        self.model_kwargs = model_kwargs
+        self.sigma = sigma
+        self.step = 0
+        self.user_data = user_data
+        self.num_tokens_for_img = z.size(-1)*z.size(-2) // 4
+        # the condition key/value states of each layer, its cropped attention mask and position ids, set by the prefill
+        self.key_cache = None
+        self.value_cache = None
+        self.attention_mask = None
+        self.position_ids = None
+        # whether it takes part in the packed steps, i.e., its prefill happened in an earlier step
+        self.joined = False
+
+    @property
+    def finished(self):
+        return self.step >= len(self.sigma) - 1
+
+    @property
+    def condition_length(self):
+        return self.key_cache[0].size(-2)
+
+    def release(self):
+        self.key_cache, self.value_cache, self.attention_mask, self.position_ids = None, None, None, None
+        self.model_kwargs = None
+
+
+class OmniGenContinuousScheduler(OmniGenScheduler):
+    """
+    Step-level continuous batching: keeps a running set of generations, each with its own step, sigma schedule, latent and kv cache.
+    Every `step()` prefills up to `max_prefills_per_step` waiting generations (their first step runs alone, which fills their condition cache),
+    then runs one denoising step for all the other running generations, packed into one forward per latent size.
+    Generations join as soon as their prefill is done and leave as soon as they finish, so a late request does not wait for a whole batch.
+
+    Generations are added with the inputs of `forward_with_cfg` (i.e., `OmniGenPipeline.prepare_inputs(..., separate_cfg_infer=False)`).
+    The condition states of the packed generations are left padded to the same length and concatenated, 
+    the packed cache is only rebuilt when the set of generations in a forward changes.
+    """
+    def __init__(self, model, num_steps: int=50, time_shifting_factor: int=1, max_running: int=8, max_batch_size: int=24, max_prefills_per_step: int=1):
+        super().__init__(num_steps, time_shifting_factor)
+        self.model = model
+        self.max_running = max_running
+        self.max_batch_size = max_batch_size
+        self.max_prefills_per_step = max_prefills_per_step
+        self.waiting = deque()
+        self.running = []
+        self.packed = {}
+
+    def __len__(self):
+        return len(self.waiting) + len(self.running)
+
+    def add(self, z, model_kwargs, num_steps: int=None, time_shifting_factor: int=None, user_data=None):
+        "Queues a generation, `user_data` is kept on the returned `OmniGenGeneration` to identify it when it finishes"
+        if isinstance(model_kwargs['input_ids'], list):
+            raise ValueError("OmniGenContinuousScheduler needs the inputs of forward_with_cfg, please prepare them with separate_cfg_infer=False")
+        if num_steps is None and time_shifting_factor is None:
+            sigma = self.sigma
+        else:
+            sigma = self.get_sigmas(num_steps or self.num_steps, time_shifting_factor or self.time_shift)
+        generation = OmniGenGeneration(z, dict(model_kwargs, use_kv_cache=True), sigma, user_data)
+        self.waiting.append(generation)
+        return generation
+
+    def prefill(self, generation):
+        "Runs the first step of a generation alone, and keeps its condition cache and the cropped inputs for the next steps"
+        z, model_kwargs = generation.z, generation.model_kwargs
+        cache = OmniGenCache(generation.num_tokens_for_img, offload_kv_cache=False)
+        model_kwargs['attention_mask'] = self.prepare_attention_mask(model_kwargs['attention_mask'], z.dtype, z.device)
+        timesteps = torch.zeros(size=(len(z), )).to(z.device) + generation.sigma[0]
+        pred, cache = self.model.forward_with_cfg(z, timesteps, past_key_values=cache, **model_kwargs)
+        generation.z = z + (generation.sigma[1] - generation.sigma[0]) * pred
+        generation.step = 1
+
+        self.crop_inputs_for_cache(model_kwargs, generation.num_tokens_for_img, [0])
+        generation.key_cache, generation.value_cache = cache.key_cache, cache.value_cache
+        generation.attention_mask, generation.position_ids = model_kwargs['attention_mask'], model_kwargs['position_ids']
+        # the condition is read from the cache from now on
+        model_kwargs['input_img_latents'], model_kwargs['input_img_embeds_cache'] = None, None
+
+    def group_key(self, generation):
+        "Generations can share a forward if their latents have the same shape and dtype and they use the same rotary scaling"
+        rope_scaling = getattr(self.model.llm.config, "rope_scaling", None)
+        long_rope = False
+        if rope_scaling is not None:
+            # the long factors of LongRoPE are selected by the max position id of the whole batch
+            long_rope = int(generation.position_ids.max()) + 1 > self.model.llm.config.original_max_position_embeddings
+        return (tuple(generation.z.shape[1:]), generation.z.dtype, long_rope)
+
+    def make_groups(self, generations):
+        "Splits the generations into the batches of the packed forwards"
+        groups = OrderedDict()
+        for generation in generations:
+            groups.setdefault(self.group_key(generation), []).append(generation)
+        batches = []
+        for group in groups.values():
+            batch, num_rows = [], 0
+            for generation in group:
+                if len(batch) > 0 and num_rows + len(generation.z) > self.max_batch_size:
+                    batches.append(batch)
+                    batch, num_rows = [], 0
+                batch.append(generation)
+                num_rows += len(generation.z)
+            batches.append(batch)
+        return batches
+
+    def pack(self, batch):
+        """
+        Concatenates the condition states, attention masks and position ids of a batch of generations.
+        Afterwards, the generations hold views into the packed tensors, so the states are not kept twice.
+        """
+        num_tokens_for_img = batch[0].num_tokens_for_img
+        max_length = max(g.condition_length for g in batch)
+        cache = OmniGenCache(num_tokens_for_img, offload_kv_cache=False)
+        for layer_idx in range(len(batch[0].key_cache)):
+            # left pad the condition of each generation, the padding is masked out below
+            key_states = torch.cat([torch.nn.functional.pad(g.key_cache[layer_idx], (0, 0, max_length - g.condition_length, 0)) for g in batch], dim=0)
+            value_states = torch.cat([torch.nn.functional.pad(g.value_cache[layer_idx], (0, 0, max_length - g.condition_length, 0)) for g in batch], dim=0)
+            cache.store_condition(key_states, value_states, layer_idx)
+        min_value = torch.finfo(batch[0].attention_mask.dtype).min
+        attention_mask = torch.cat([torch.nn.functional.pad(g.attention_mask, (max_length - g.condition_length, 0), value=min_value) for g in batch], dim=0)
+        position_ids = torch.cat([g.position_ids for g in batch], dim=0)
+
+        start_inx = 0
+        for g in batch:
+            end_inx, pad = start_inx + len(g.z), max_length - g.condition_length
+            g.key_cache = [x[start_inx:end_inx, :, pad:, :] for x in cache.key_cache]
+            g.value_cache = [x[start_inx:end_inx, :, pad:, :] for x in cache.value_cache]
+            g.attention_mask = attention_mask[start_inx:end_inx, :, :, pad:]
+            g.position_ids = position_ids[start_inx:end_inx]
+            start_inx = end_inx
+        # every cfg branch of every generation keeps its own feature cache state
+        cache.feature_blocks, start_inx = [], 0
+        for g in batch:
+            num_branches = 3 if g.model_kwargs['use_img_cfg'] else 2
+            size = len(g.z) // num_branches
+            cache.feature_blocks.extend((start_inx + i * size, start_inx + (i + 1) * size) for i in range(num_branches))
+            start_inx += len(g.z)
+        return cache, attention_mask, position_ids
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Admits and prefills waiting generations, then runs one denoising step for the other running generations. 
+        Returns the generations which finished in this step, their final latents are in `generation.z`.
+        """
+        finished = []
+        num_prefills = 0
+        while len(self.waiting) > 0 and len(self.running) < self.max_running and num_prefills < self.max_prefills_per_step:
+            generation = self.waiting.popleft()
+            self.prefill(generation)
+            num_prefills += 1
+            if generation.finished:
+                finished.append(generation)
+            else:
+                self.running.append(generation)
+
+        packed = {}
+        self.model.llm.config.use_cache = True
+        for batch in self.make_groups([g for g in self.running if g.joined]):
+            members = tuple(g.id for g in batch)
+            if members not in self.packed:
+                self.packed[members] = self.pack(batch)
+            packed[members] = self.packed[members]
+            cache, attention_mask, position_ids = packed[members]
+
+            z = torch.cat([g.z for g in batch], dim=0)
+            timesteps = torch.cat([torch.zeros(size=(len(g.z), )) + g.sigma[g.step] for g in batch], dim=0).to(z.device)
+            model_out, _ = self.model.forward(z, timesteps, None, None, None, attention_mask, position_ids, past_key_values=cache, return_past_key_values=True)
+
+            start_inx = 0
+            for g in batch:
+                end_inx = start_inx + len(g.z)
+                kwargs = g.model_kwargs
+                pred = self.model.combine_cfg(model_out[start_inx:end_inx], kwargs['cfg_scale'], kwargs['use_img_cfg'], kwargs['img_cfg_scale'])
+                g.z = g.z + (g.sigma[g.step+1] - g.sigma[g.step]) * pred
+                g.step += 1
+                start_inx = end_inx
+
+        for g in self.running:
+            g.joined = True
+        # drop the packed states of the batches that changed
+        self.packed = packed
+        for g in self.running:
+            if g.finished:
+                finished.append(g)
+        self.running = [g for g in self.running if not g.finished]
+        for g in finished:
+            g.release()
+        return finished
+
+    def run(self):
+        "Steps until all the queued generations are finished, and yields them as they finish"
+        while len(self) > 0:
+            for generation in self.step():
+                yield generation
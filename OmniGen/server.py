@@ -0,0 +1,336 @@
+"""
+A local HTTP server around OmniGenPipeline, which queues the incoming requests and coalesces compatible ones
+(same resolution, steps and guidance settings) into one batched pipeline call.
+
+    python -m OmniGen.server --model Shitao/OmniGen-v1 --port 8000 --max_batch_size 4 [--continuous]
+
+    curl -X POST localhost:8000/generate -d '{"prompt": "a photo of a cat", "height": 512, "width": 512, "seed": 0}'
+
+The response is a json object with the generated image as a base64 encoded png.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from PIL import Image
+from diffusers.utils import logging
+
+from OmniGen.scheduler import OmniGenContinuousScheduler
+
+
+logger = logging.get_logger(__name__)
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class OmniGenBatcher:
+    """
+    Collects requests in a bounded queue and runs them through the pipeline in batches.
+    A batch is started by the oldest pending request and filled, for up to `batch_window` seconds,
+    with the pending requests that can share its pipeline call, at most `max_batch_size` of them.
+    The pipeline runs in a single worker thread, so the GPU is never shared by two batches.
+    """
+    # the pipeline arguments which must be the same for all prompts of one call
+    batch_keys = ("height", "width", "num_inference_steps", "guidance_scale", "img_guidance_scale",
+                  "use_img_guidance", "max_input_image_size", "separate_cfg_infer", "use_kv_cache", "offload_kv_cache")
+
+    def __init__(self, pipeline, max_batch_size: int = 4, batch_window: float = 0.05, max_queue_size: int = 32, **default_kwargs):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_queue_size = max_queue_size
+        self.default_kwargs = dict(height=1024, width=1024, num_inference_steps=50, guidance_scale=3, img_guidance_scale=1.6,
+                                   use_img_guidance=True, max_input_image_size=1024, separate_cfg_infer=True,
+                                   use_kv_cache=True, offload_kv_cache=True)
+        self.default_kwargs.update(default_kwargs)
+
+        self.pending = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.queue = asyncio.run_coroutine_threadsafe(self._make_queue(), self.loop).result()
+        self.batch_task = asyncio.run_coroutine_threadsafe(self._batch_loop(), self.loop)
+
+    async def _make_queue(self):
+        return asyncio.Queue()
+
+    def batch_key(self, request):
+        has_images = request.get("input_images") is not None and len(request["input_images"]) > 0
+        return tuple(request[k] for k in self.batch_keys) + (has_images,)
+
+    def submit(self, request: dict):
+        """
+        Queues one request (a dict with "prompt" and optionally "input_images", "seed" and the pipeline arguments in `batch_keys`)
+        and returns a concurrent future resolving to its PIL image. Raises QueueFullError if the queue is full.
+        """
+        unknown = set(request) - set(self.batch_keys) - {"prompt", "input_images", "seed"}
+        if len(unknown) > 0:
+            raise ValueError(f"Unsupported arguments: {sorted(unknown)}")
+        request = {**self.default_kwargs, **request}
+        # the http handlers run in their own threads, so they wait on a concurrent future
+        future = Future()
+        asyncio.run_coroutine_threadsafe(self._enqueue(request, future), self.loop).result()
+        return future
+
+    async def _enqueue(self, request, future):
+        # the requests waiting for a compatible batch count towards the limit as well
+        if self.qsize() >= self.max_queue_size:
+            raise QueueFullError(f"The request queue is full ({self.max_queue_size} requests)")
+        self.queue.put_nowait((request, future))
+
+    def qsize(self):
+        return self.queue.qsize() + len(self.pending)
+
+    async def _next_batch(self):
+        if len(self.pending) == 0:
+            self.pending.append(await self.queue.get())
+        key = self.batch_key(self.pending[0][0])
+        deadline = time.monotonic() + self.batch_window
+        while sum(self.batch_key(r) == key for r, _ in self.pending) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                self.pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        batch, rest = [], []
+        for item in self.pending:
+            if len(batch) < self.max_batch_size and self.batch_key(item[0]) == key:
+                batch.append(item)
+            else:
+                rest.append(item)
+        self.pending = rest
+        return batch
+
+    async def _batch_loop(self):
+        while True:
+            batch = await self._next_batch()
+            # drop the requests whose client gave up while they were queued
+            batch = [(r, f) for r, f in batch if f.set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            try:
+                images = await self.loop.run_in_executor(self.executor, self._run_batch, [r for r, _ in batch])
+            except Exception as e:
+                logger.error(f"Batch of {len(batch)} requests failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), image in zip(batch, images):
+                future.set_result(image)
+
+    def _run_batch(self, requests):
+        kwargs = {k: requests[0][k] for k in self.batch_keys}
+        input_images = None
+        if requests[0].get("input_images"):
+            input_images = [r["input_images"] for r in requests]
+        start_time = time.time()
+        images = self.pipeline(
+            prompt=[r["prompt"] for r in requests],
+            input_images=input_images,
+            seed=[r.get("seed") for r in requests],
+            **kwargs,
+        )
+        logger.info(f"Generated a batch of {len(requests)} images in {time.time() - start_time:.2f}s")
+        return images
+
+    def close(self):
+        self.batch_task.cancel()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+
+
+class OmniGenContinuousBatcher:
+    """
+    Serves the requests with `OmniGenContinuousScheduler`: a request joins the running generations after its own prefill 
+    and leaves as soon as its last step is done, so requests with different sizes, steps or guidance scales can be served together.
+    Requests use the joint cfg inputs and the kv cache, `separate_cfg_infer` and `use_kv_cache` are ignored.
+    """
+    def __init__(self, pipeline, max_running: int = 8, max_batch_size: int = 24, max_queue_size: int = 32, dtype: torch.dtype = torch.bfloat16, **default_kwargs):
+        self.pipeline = pipeline
+        self.max_queue_size = max_queue_size
+        self.dtype = dtype
+        self.default_kwargs = dict(height=1024, width=1024, num_inference_steps=50, guidance_scale=3, img_guidance_scale=1.6, use_img_guidance=True, 
+                                   max_input_image_size=1024)
+        self.default_kwargs.update(default_kwargs)
+        self.scheduler = OmniGenContinuousScheduler(pipeline.model, max_running=max_running, max_batch_size=max_batch_size)
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.num_queued = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: dict):
+        "Same as `OmniGenBatcher.submit`"
+        unknown = set(request) - set(OmniGenBatcher.batch_keys) - {"prompt", "input_images", "seed"}
+        if len(unknown) > 0:
+            raise ValueError(f"Unsupported arguments: {sorted(unknown)}")
+        request = {**self.default_kwargs, **request}
+        with self.lock:
+            # the admitted requests waiting for their prefill count towards the limit as well
+            if self.qsize() >= self.max_queue_size:
+                raise QueueFullError(f"The request queue is full ({self.max_queue_size} requests)")
+            self.num_queued += 1
+        future = Future()
+        self.requests.put((request, future))
+        return future
+
+    def qsize(self):
+        return self.num_queued + len(self.scheduler.waiting)
+
+    def _add(self, request, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            input_images = request.get("input_images") or None
+            # the input images are resized by the processor during the prefill, each request brings its own size
+            self.pipeline.set_max_input_image_size(request["max_input_image_size"])
+            z, model_kwargs, num_cfg = self.pipeline.prepare_inputs(
+                [request["prompt"]], None if input_images is None else [input_images], height=request["height"], width=request["width"],
+                guidance_scale=request["guidance_scale"], use_img_guidance=request["use_img_guidance"] and input_images is not None, 
+                img_guidance_scale=request["img_guidance_scale"], max_input_image_size=request["max_input_image_size"], 
+                separate_cfg_infer=False, dtype=self.dtype, seed=request.get("seed"))
+            self.scheduler.add(z, model_kwargs, num_steps=request["num_inference_steps"], user_data=(future, num_cfg))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _worker(self):
+        self.pipeline.disable_model_cpu_offload(self.dtype)
+        while not self.stopped:
+            # block only when there is nothing to denoise
+            try:
+                while True:
+                    item = self.requests.get(block=len(self.scheduler) == 0, timeout=1 if len(self.scheduler) == 0 else None)
+                    with self.lock:
+                        self.num_queued -= 1
+                    self._add(*item)
+            except queue.Empty:
+                pass
+            if len(self.scheduler) == 0:
+                continue
+
+            try:
+                finished = self.scheduler.step()
+            except Exception as e:
+                logger.error(f"Denoising step failed: {e}")
+                finished = list(self.scheduler.waiting) + self.scheduler.running
+                self.scheduler.waiting.clear()
+                self.scheduler.running = []
+                for generation in finished:
+                    generation.user_data[0].set_exception(e)
+                continue
+            for generation in finished:
+                future, num_cfg = generation.user_data
+                try:
+                    future.set_result(self.pipeline.decode_latents(generation.z.chunk(1+num_cfg, dim=0)[0])[0])
+                except Exception as e:
+                    future.set_exception(e)
+
+    def close(self):
+        self.stopped = True
+
+
+def decode_image(data: str):
+    "Input images are sent as base64 encoded files, optionally as data urls"
+    if data.startswith("data:"):
+        data = data.split(",", 1)[1]
+    return Image.open(io.BytesIO(base64.b64decode(data))).convert("RGB")
+
+
+def encode_image(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def make_handler(batcher: OmniGenBatcher, request_timeout: float = None):
+    class OmniGenRequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self.send_json(404, {"error": "not found"})
+            self.send_json(200, {"status": "ok", "queued": batcher.qsize(), "max_queue_size": batcher.max_queue_size})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                return self.send_json(404, {"error": "not found"})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if not isinstance(request.get("prompt"), str):
+                    raise ValueError("'prompt' must be a string")
+                if request.get("input_images") is not None:
+                    request["input_images"] = [decode_image(x) for x in request["input_images"]]
+                future = batcher.submit(request)
+            except QueueFullError as e:
+                return self.send_json(503, {"error": str(e)})
+            except Exception as e:
+                return self.send_json(400, {"error": str(e)})
+
+            try:
+                image = future.result(timeout=request_timeout)
+            except Exception as e:
+                future.cancel()
+                return self.send_json(500, {"error": str(e)})
+            self.send_json(200, {"image": encode_image(image)})
+
+        def log_message(self, format, *args):
+            logger.info("%s - %s" % (self.address_string(), format % args))
+
+    return OmniGenRequestHandler
+
+
+def serve(pipeline, host: str = "127.0.0.1", port: int = 8000, max_batch_size: int = 4, batch_window: float = 0.05,
+          max_queue_size: int = 32, request_timeout: float = None, continuous: bool = False, **default_kwargs):
+    if continuous:
+        batcher = OmniGenContinuousBatcher(pipeline, max_running=max_batch_size, max_queue_size=max_queue_size, **default_kwargs)
+    else:
+        batcher = OmniGenBatcher(pipeline, max_batch_size=max_batch_size, batch_window=batch_window, max_queue_size=max_queue_size, **default_kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, request_timeout))
+    logger.info(f"Serving OmniGen on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="Shitao/OmniGen-v1")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=4)
+    parser.add_argument("--batch_window", type=float, default=0.05, help="seconds to wait for compatible requests before starting a batch")
+    parser.add_argument("--max_queue_size", type=int, default=32, help="requests beyond this are rejected with 503")
+    parser.add_argument("--request_timeout", type=float, default=None)
+    parser.add_argument("--continuous", action="store_true", help="step-level continuous batching instead of batching whole requests")
+    args = parser.parse_args()
+
+    from OmniGen import OmniGenPipeline
+    logging.set_verbosity_info()
+    pipe = OmniGenPipeline.from_pretrained(args.model)
+    serve(pipe, host=args.host, port=args.port, max_batch_size=args.max_batch_size, batch_window=args.batch_window,
+          max_queue_size=args.max_queue_size, request_timeout=args.request_timeout, continuous=args.continuous)
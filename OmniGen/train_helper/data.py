@@ -91,7 +91,7 @@ class TrainDataCollator(OmniGenCollator):
         output_images = [f[1].unsqueeze(0) for f in features]
         target_img_size = [[x.size(-2), x.size(-1)] for x in output_images]
 
-        all_padded_input_ids, all_position_ids, all_attention_mask, all_padding_images, all_pixel_values, all_image_sizes = self.process_mllm_input(mllm_inputs, target_img_size)
+        all_padded_input_ids, all_position_ids, all_attention_mask, all_padding_images, all_pixel_values, all_image_sizes, _ = self.process_mllm_input(mllm_inputs, target_img_size)
 
         if not self.keep_raw_resolution:
             output_images = torch.cat(output_images, dim=0)
@@ -1,5 +1,7 @@
 import math
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Tuple, Union
 
 import torch
@@ -7,6 +9,7 @@ import torch.utils.checkpoint
 from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 from huggingface_hub import snapshot_download
+from safetensors import safe_open
 
 from transformers.modeling_outputs import (
     BaseModelOutputWithPast,
@@ -22,6 +25,315 @@ from transformers.utils import logging
 logger = logging.get_logger(__name__)
 
 
+class OmniGenAttentionMask:
+    """
+    Compact description of the attention mask of OmniGen, which is only materialized when it is needed.
+    Each row is laid out as [left padding, condition tokens, time token, output image tokens]: 
+    the condition tokens and the time token attend causally, the tokens of an input image also attend to each other bidirectionally, 
+    the output image tokens attend to everything except the left padding, and the padding of smaller output images is never attended to.
+    Args:
+        pad_lengths: number of left padding tokens of each row
+        text_length: length of the padded condition (without the time token)
+        num_tokens_for_output_images: number of output image tokens of each row
+        image_sizes: the [start, end) spans of the input images, indexed by row
+    """
+    def __init__(self, pad_lengths, text_length: int, num_tokens_for_output_images: List[int], image_sizes: Optional[dict] = None, device: Union[str, torch.device] = "cpu"):
+        self.pad_lengths = torch.as_tensor(pad_lengths, dtype=torch.long)
+        self.text_length = int(text_length)
+        self.num_tokens_for_output_images = [int(x) for x in num_tokens_for_output_images]
+        self.image_sizes = image_sizes if image_sizes is not None else {}
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.num_tokens_for_output_images)
+
+    @property
+    def seq_length(self):
+        # we add a time embedding into the sequence, so add one more token
+        return self.text_length + max(self.num_tokens_for_output_images) + 1
+
+    @property
+    def shape(self):
+        return torch.Size([len(self), self.seq_length, self.seq_length])
+
+    def size(self, dim: Optional[int] = None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def to(self, device=None, *args, **kwargs):
+        "Only records the device the mask will be materialized on"
+        if device is None or isinstance(device, torch.dtype):
+            return self
+        return OmniGenAttentionMask(self.pad_lengths, self.text_length, self.num_tokens_for_output_images, self.image_sizes, device=device)
+
+    def to_bool(self) -> torch.Tensor:
+        "Builds the (batch, seq_len, seq_len) boolean mask, True means the key can be attended to"
+        batch_size, seq_len, prefix_len = len(self), self.seq_length, self.text_length + 1
+        positions = torch.arange(seq_len, device=self.device)
+        query, key = positions.view(1, -1, 1), positions.view(1, 1, -1)
+        pad_lengths = self.pad_lengths.to(self.device).view(-1, 1, 1)
+        num_img_tokens = torch.tensor(self.num_tokens_for_output_images, device=self.device).view(-1, 1, 1)
+
+        # causal attention for the condition and time tokens, full attention for the output image tokens, no attention to the left padding
+        mask = ((key <= query) | (query >= prefix_len)).expand(batch_size, seq_len, seq_len) & (key >= pad_lengths)
+        # the padding rows attend to everything, as in the dense mask
+        mask |= query < pad_lengths
+        # the padding of smaller output images is not attended to
+        mask &= key < prefix_len + num_img_tokens
+
+        if len(self.image_sizes) > 0:
+            image_ids = torch.zeros(batch_size, self.text_length, dtype=torch.long)
+            image_inx = 0
+            for b_inx in self.image_sizes.keys():
+                for start_inx, end_inx in self.image_sizes[b_inx]:
+                    image_inx += 1
+                    image_ids[b_inx, start_inx:end_inx] = image_inx
+            image_ids = image_ids.to(self.device)
+            same_image = (image_ids.unsqueeze(2) == image_ids.unsqueeze(1)) & (image_ids.unsqueeze(2) > 0)
+            mask[:, :self.text_length, :self.text_length] |= same_image
+        return mask
+
+    def to_dense(self, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+        "Builds the dense 0/1 mask of shape (batch, seq_len, seq_len)"
+        return self.to_bool().to(dtype)
+
+    def to_additive(self, dtype: torch.dtype) -> torch.Tensor:
+        "Builds the additive mask of shape (batch, 1, seq_len, seq_len) used by the attention layers"
+        mask = self.to_bool()
+        attention_mask = torch.full(mask.shape, torch.finfo(dtype).min, dtype=dtype, device=self.device)
+        attention_mask.masked_fill_(mask, 0)
+        return attention_mask.unsqueeze(1)
+
+
+class OmniGenRotaryCache(nn.Module):
+    """
+    Wraps the rotary embedding of the attention layers and memoizes its cos/sin tables, so they are computed once 
+    for all the layers of a forward and reused by the next steps of a generation, which pass the same `position_ids` tensor.
+    Entries are keyed by the identity of `position_ids` (a reference is kept, so the id is not reused), `seq_len` 
+    (LongRoPE picks its scaling factors by the sequence length), and the dtype and device of the output.
+    `seq_len_override` replaces the `seq_len` of the attention layers, e.g., the token merging sets the kv length of the unmerged sequence, 
+    so the merged layers use the same LongRoPE factors as the other layers and the cached condition.
+    """
+    def __init__(self, rotary_emb: nn.Module, max_entries: int = 8):
+        super().__init__()
+        self.rotary_emb = rotary_emb
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.seq_len_override = None
+
+    def clear(self):
+        self.entries.clear()
+
+    def forward(self, x, position_ids, seq_len=None):
+        if self.seq_len_override is not None:
+            seq_len = self.seq_len_override
+        if torch.is_grad_enabled():
+            return self.rotary_emb(x, position_ids, seq_len=seq_len)
+        key = (id(position_ids), int(seq_len) if seq_len is not None else None, x.dtype, x.device)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is position_ids:
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+        cos, sin = self.rotary_emb(x, position_ids, seq_len=seq_len)
+        self.entries[key] = (position_ids, cos, sin)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return cos, sin
+
+
+class OmniGenFeatureCache:
+    """
+    Opt-in step-to-step cache of the transformer output (TeaCache / first block cache style), only used for the steps which read the condition from the kv cache.
+    The first layer always runs, and the relative L1 change of its residual since the previous step is accumulated. 
+    While the accumulated change stays below `threshold`, the other layers are skipped and the residual they added in the last full forward is reused.
+    At most `max_skips` steps are skipped in a row. The state is kept per cfg branch (per row block of the kv cache, see `OmniGenCache.feature_states`),
+    and `skip_rate` reports the fraction of skipped branch forwards. The layers only stop early if all the branches of a forward can skip, 
+    otherwise every branch runs the full forward and takes its fresh output, like a branch which can't skip.
+    """
+    def __init__(self, threshold: float = 0.1, max_skips: int = 3):
+        self.threshold = threshold
+        self.max_skips = max_skips
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_forwards = 0
+        self.num_skipped = 0
+
+    @property
+    def skip_rate(self):
+        return self.num_skipped / max(self.num_forwards, 1)
+
+    def can_skip(self, state: dict, first_residual: torch.Tensor) -> bool:
+        """
+        Decides whether the layers after the first one can be skipped, given the residual of the first layer. 
+        The decision takes effect with `record`, since a branch only skips if all the branches of the forward can.
+        """
+        prev_residual = state.get("first_residual")
+        state["first_residual"] = first_residual
+        if prev_residual is None or "residual" not in state or prev_residual.shape != first_residual.shape:
+            state["accumulated"], state["num_skips"] = 0.0, 0
+            return False
+        change = ((first_residual - prev_residual).abs().mean() / prev_residual.abs().mean().clamp_min(1e-6)).item()
+        state["accumulated"] += change
+        return state["accumulated"] < self.threshold and state["num_skips"] < self.max_skips
+
+    def record(self, state: dict, skipped: bool):
+        "Updates the state and the stats after a forward of the branch, which ran the full layers unless `skipped`"
+        self.num_forwards += 1
+        if skipped:
+            state["num_skips"] += 1
+            self.num_skipped += 1
+        else:
+            state["accumulated"], state["num_skips"] = 0.0, 0
+
+
+class OmniGenTokenMerging:
+    """
+    Optional spatial token merging of the output image tokens for the layers [start_layer, end_layer). 
+    Before `start_layer`, each `stride` x `stride` block of image tokens is averaged into one token (a merge ratio of 1 - 1/stride^2),
+    and after `end_layer - 1`, the change made by these layers is copied back to every token of the block.
+    It only applies to the steps which read the condition from the kv cache, to images with at least `min_tokens` tokens whose grid is divisible by `stride`, 
+    and to batches without padded output images.
+    """
+    def __init__(self, stride: int = 2, start_layer: int = 2, end_layer: int = 30, min_tokens: int = 4096):
+        assert stride > 1, "stride should be larger than 1"
+        assert 1 <= start_layer < end_layer, "the first layer always runs unmerged, so 1 <= start_layer < end_layer is required"
+        self.stride = stride
+        self.start_layer = start_layer
+        self.end_layer = end_layer
+        self.min_tokens = min_tokens
+
+    def applies(self, image_grid, seq_length: int) -> bool:
+        if image_grid is None:
+            return False
+        height, width = image_grid
+        # the sequence of a cached step is [time token, image tokens]
+        return seq_length == 1 + height * width and height * width >= self.min_tokens and height % self.stride == 0 and width % self.stride == 0
+
+    def merge(self, tokens, image_grid):
+        "(B, h*w, D) -> (B, h*w/stride^2, D), the mean of each block"
+        (height, width), s = image_grid, self.stride
+        tokens = tokens.view(tokens.size(0), height // s, s, width // s, s, tokens.size(-1))
+        return tokens.mean(dim=(2, 4)).flatten(1, 2)
+
+    def unmerge(self, tokens, image_grid):
+        "(B, h*w/stride^2, D) -> (B, h*w, D), repeats each token over its block"
+        (height, width), s = image_grid, self.stride
+        tokens = tokens.view(tokens.size(0), height // s, 1, width // s, 1, tokens.size(-1))
+        return tokens.expand(-1, -1, s, -1, s, -1).reshape(tokens.size(0), height * width, tokens.size(-1))
+
+    def merge_position_ids(self, position_ids, image_grid):
+        "Each merged token takes the position of the top left token of its block"
+        (height, width), s = image_grid, self.stride
+        image_position_ids = position_ids[:, 1:].view(-1, height, width)[:, ::s, ::s].flatten(1)
+        return torch.cat([position_ids[:, :1], image_position_ids], dim=1)
+
+    def merge_attention_mask(self, attention_mask, num_merged_tokens: int):
+        "All the image queries and keys have the same mask without padded images, so the mask of the merged tokens is a slice"
+        num_tokens = attention_mask.size(-2) - 1
+        return attention_mask[:, :, :num_merged_tokens+1, :attention_mask.size(-1)-num_tokens+num_merged_tokens]
+
+
+class OmniGenLayerStreamer:
+    """
+    Streams the weights of the decoder layers from the memory-mapped safetensors checkpoint, so only a few layers are resident at a time.
+    The weights of a layer are read (and cast to the dtype and device of the forward) just before it runs, and the next `window - 1` layers 
+    are read ahead by a background thread. Layers which are not resident keep meta tensors as parameters, 
+    so the host memory scales with `window` instead of the number of layers. Works on CPU, no CUDA stream is needed.
+    Args:
+        layers: the decoder layers
+        checkpoint_path: path of model.safetensors
+        prefix: prefix of the layer weights in the checkpoint, the key of a weight is f"{prefix}{layer_idx}.{name}"
+        window: number of layers resident or being read at the same time, at least 1
+    """
+    def __init__(self, layers: nn.ModuleList, checkpoint_path: str, prefix: str = "llm.layers.", window: int = 2):
+        assert window >= 1, "window should be at least 1"
+        self.layers = layers
+        self.checkpoint_path = checkpoint_path
+        self.prefix = prefix
+        self.window = min(window, len(layers))
+        self.resident = set()
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="omnigen-layer-streamer")
+        self.handle = None  # only used by the worker thread
+
+        with safe_open(checkpoint_path, framework="pt", device="cpu") as f:
+            keys = set(f.keys())
+        missing = [f"{prefix}{i}.{name}" for i, layer in enumerate(layers) for name, _ in layer.named_parameters() if f"{prefix}{i}.{name}" not in keys]
+        if len(missing) > 0:
+            raise ValueError(f"{checkpoint_path} has no weights for {missing[:4]}{'...' if len(missing) > 4 else ''}")
+
+    def read_layer(self, layer_idx: int, device: torch.device, dtype: torch.dtype):
+        "Runs on the worker thread"
+        if self.handle is None:
+            self.handle = safe_open(self.checkpoint_path, framework="pt", device="cpu")
+        tensors = {}
+        for name, param in self.layers[layer_idx].named_parameters():
+            tensor = self.handle.get_tensor(f"{self.prefix}{layer_idx}.{name}")
+            tensors[name] = tensor.to(device=device, dtype=dtype if tensor.is_floating_point() else tensor.dtype)
+        return tensors
+
+    def prefetch(self, layer_idx: int, device: torch.device, dtype: torch.dtype):
+        if layer_idx in self.resident:
+            return
+        entry = self.pending.get(layer_idx)
+        if entry is not None and entry[0] == (device, dtype):
+            return
+        self.pending[layer_idx] = ((device, dtype), self.executor.submit(self.read_layer, layer_idx, device, dtype))
+
+    def assign(self, layer_idx: int, tensors: dict):
+        "The parameters are replaced, since `.data` can't switch between meta and real tensors"
+        layer = self.layers[layer_idx]
+        for name, param in list(layer.named_parameters()):
+            module_name, _, param_name = name.rpartition(".")
+            module = layer.get_submodule(module_name) if module_name else layer
+            module._parameters[param_name] = nn.Parameter(tensors[name], requires_grad=param.requires_grad)
+
+    def release(self, layer_idx: int):
+        self.assign(layer_idx, {name: torch.empty_like(param, device="meta") for name, param in self.layers[layer_idx].named_parameters()})
+        self.resident.discard(layer_idx)
+
+    def load_layer(self, layer_idx: int, device: torch.device, dtype: torch.dtype):
+        "Makes the weights of `layer_idx` resident, reads ahead the next layers and releases the others"
+        window = [(layer_idx + i) % len(self.layers) for i in range(self.window)]
+        for idx in list(self.pending):
+            if idx not in window:
+                # e.g., the feature cache stopped the previous forward after the first layer
+                self.pending.pop(idx)[1].cancel()
+        for idx in list(self.resident):
+            if idx != layer_idx:
+                self.release(idx)
+        if layer_idx in self.resident:
+            param = next(self.layers[layer_idx].parameters())
+            if param.device != device or param.dtype != dtype:
+                self.release(layer_idx)
+        for idx in window:
+            self.prefetch(idx, device, dtype)
+
+        if layer_idx not in self.resident:
+            self.assign(layer_idx, self.pending.pop(layer_idx)[1].result())
+            self.resident.add(layer_idx)
+
+    def release_all(self):
+        for _, future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        for idx in range(len(self.layers)):
+            self.release(idx)
+
+    def materialize(self, device: torch.device, dtype: torch.dtype):
+        "Loads all the layers back, e.g., to stop streaming"
+        self.release_all()
+        for layer_idx in range(len(self.layers)):
+            self.assign(layer_idx, self.executor.submit(self.read_layer, layer_idx, device, dtype).result())
+
+    def close(self):
+        for _, future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+        self.handle = None
+
+
 class Phi3Transformer(Phi3Model):
     """
     Transformer decoder consisting of *config.num_hidden_layers* layers. Each layer is a [`Phi3DecoderLayer`]
@@ -29,6 +341,43 @@ class Phi3Transformer(Phi3Model):
     Args:
         config: Phi3Config
     """
+    def __init__(self, config: Phi3Config):
+        super().__init__(config)
+        # all the layers use the same rotary embedding, share one caching wrapper
+        rotary_cache = OmniGenRotaryCache(self.layers[0].self_attn.rotary_emb)
+        for layer in self.layers:
+            layer.self_attn.rotary_emb = rotary_cache
+        self.feature_cache = None
+        self.token_merging = None
+        self.layer_streamer = None
+
+    def _apply(self, fn, *args, **kwargs):
+        if self.layer_streamer is None:
+            return super()._apply(fn, *args, **kwargs)
+        # the released layers hold meta tensors, which can change their dtype but can't be copied to a device
+        def apply_fn(tensor):
+            try:
+                return fn(tensor)
+            except NotImplementedError:
+                if tensor.is_meta:
+                    return tensor
+                raise
+        return super()._apply(apply_fn, *args, **kwargs)
+
+    def enable_layer_streaming(self, checkpoint_path: str, window: int = 2, prefix: str = "llm.layers."):
+        "Frees the weights of the decoder layers and reads them from `checkpoint_path` during the forward, see `OmniGenLayerStreamer`"
+        self.disable_layer_streaming()
+        self.layer_streamer = OmniGenLayerStreamer(self.layers, checkpoint_path, prefix=prefix, window=window)
+        self.layer_streamer.release_all()
+
+    def disable_layer_streaming(self):
+        "Loads all the decoder layers back"
+        if self.layer_streamer is None:
+            return
+        self.layer_streamer.materialize(self.norm.weight.device, self.norm.weight.dtype)
+        self.layer_streamer.close()
+        self.layer_streamer = None
+
     def prefetch_layer(self, layer_idx: int, device: torch.device):
         "Starts prefetching the next layer cache"
         with torch.cuda.stream(self.prefetch_stream):
@@ -58,6 +407,20 @@ class Phi3Transformer(Phi3Model):
         self.prefetch_layer((layer_idx + 1) % len(self.layers), device)
         
 
+    @staticmethod
+    def prepare_attention_mask(attention_mask: Union[torch.Tensor, OmniGenAttentionMask], dtype: torch.dtype, device: Optional[torch.device] = None) -> torch.Tensor:
+        """
+        Turns the 0/1 mask of shape (batch, query_len, key_len) or an `OmniGenAttentionMask` into the additive (batch, 1, query_len, key_len) mask used by the attention layers.
+        A 4-D mask is regarded as already prepared and is only cast to `dtype` if needed, so callers can do the conversion once per generation.
+        """
+        if isinstance(attention_mask, OmniGenAttentionMask):
+            return attention_mask.to(device).to_additive(dtype)
+        if attention_mask.dim() == 4:
+            return attention_mask.to(dtype)
+        min_dtype = torch.finfo(dtype).min
+        attention_mask = (1 - attention_mask) * min_dtype
+        return attention_mask.unsqueeze(1).to(dtype)
+
     def forward(
         self,
         input_ids: torch.LongTensor = None,
@@ -71,7 +434,11 @@ class Phi3Transformer(Phi3Model):
         return_dict: Optional[bool] = None,
         cache_position: Optional[torch.LongTensor] = None,
         offload_model: Optional[bool] = False,
+        image_grid: Optional[Tuple[int, int]] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
+        """
+        image_grid: (height, width) of the output image tokens if all rows have the same size, used by the token merging
+        """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -115,11 +482,8 @@ class Phi3Transformer(Phi3Model):
         # if position_ids is None:
         #     position_ids = cache_position.unsqueeze(0)
 
-        if attention_mask is not None and attention_mask.dim() == 3:
-            dtype = inputs_embeds.dtype
-            min_dtype = torch.finfo(dtype).min
-            attention_mask = (1 - attention_mask) * min_dtype
-            attention_mask = attention_mask.unsqueeze(1).to(inputs_embeds.dtype)
+        if isinstance(attention_mask, OmniGenAttentionMask) or (attention_mask is not None and attention_mask.dim() in (3, 4)):
+            attention_mask = self.prepare_attention_mask(attention_mask, inputs_embeds.dtype, device=inputs_embeds.device)
         else:
             raise Exception("attention_mask parameter was unavailable or invalid")
             # causal_mask = self._update_causal_mask(
@@ -128,6 +492,23 @@ class Phi3Transformer(Phi3Model):
 
         hidden_states = inputs_embeds
 
+        # the feature cache only applies to the steps after the prefill, its state is kept on the kv cache of each cfg branch
+        # the first step of a cache seeded from the prefix cache has the attention of the prefill, so it is treated like the prefill
+        prefill = getattr(past_key_values, "condition_only", False)
+        feature_states = None
+        if self.feature_cache is not None and not self.training and not offload_model and not prefill and isinstance(past_key_values, Cache) and len(past_key_values) > 0 \
+            and hasattr(past_key_values, "feature_states"):
+            feature_states = past_key_values.feature_states(inputs_embeds.size(0))
+        skipped = False
+
+        merging = self.token_merging
+        if merging is None or self.training or prefill or merging.start_layer >= len(self.layers) or not merging.applies(image_grid, inputs_embeds.size(1)):
+            merging = None
+        layer_attention_mask, layer_position_ids = attention_mask, position_ids
+        rotary_emb = self.layers[0].self_attn.rotary_emb
+        # e.g., a forward which raised inside the merged layers
+        rotary_emb.seq_len_override = None
+
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
@@ -137,6 +518,15 @@ class Phi3Transformer(Phi3Model):
         for decoder_layer in self.layers:
             layer_idx += 1
 
+            if merging is not None and layer_idx == merging.start_layer:
+                unmerged_hidden_states = hidden_states
+                hidden_states = torch.cat([hidden_states[:, :1], merging.merge(hidden_states[:, 1:], image_grid)], dim=1)
+                merged_hidden_states = hidden_states
+                layer_attention_mask = merging.merge_attention_mask(attention_mask, hidden_states.size(1) - 1)
+                layer_position_ids = merging.merge_position_ids(position_ids, image_grid)
+                # the rotary embedding of the merged layers picks the LongRoPE factors by the unmerged kv length
+                rotary_emb.seq_len_override = unmerged_hidden_states.size(1) + (past_key_values.get_seq_length() if past_key_values is not None else 0)
+
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
 
@@ -152,26 +542,54 @@ class Phi3Transformer(Phi3Model):
                     cache_position,
                 )
             else:
-                if offload_model and not self.training:
+                if self.layer_streamer is not None:
+                    self.layer_streamer.load_layer(layer_idx, inputs_embeds.device, self.norm.weight.dtype)
+                elif offload_model and not self.training:
                     self.get_offlaod_layer(layer_idx, device=inputs_embeds.device)
                 layer_outputs = decoder_layer(
                     hidden_states,
-                    attention_mask=attention_mask,
-                    position_ids=position_ids,
+                    attention_mask=layer_attention_mask,
+                    position_ids=layer_position_ids,
                     past_key_value=past_key_values,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
                     cache_position=cache_position,
                 )
 
+            if feature_states is not None and layer_idx == 0:
+                first_hidden_states = layer_outputs[0]
+                first_residual = first_hidden_states - hidden_states
+                skip_blocks = [self.feature_cache.can_skip(state, first_residual[start:end]) for start, end, state in feature_states]
+                if all(skip_blocks):
+                    for _, _, state in feature_states:
+                        self.feature_cache.record(state, skipped=True)
+                    hidden_states = torch.cat([first_hidden_states[start:end] + state["residual"] for start, end, state in feature_states], dim=0)
+                    skipped = True
+                    if use_cache:
+                        next_decoder_cache = layer_outputs[2 if output_attentions else 1]
+                    break
+
             hidden_states = layer_outputs[0]
 
+            if merging is not None and layer_idx == min(merging.end_layer, len(self.layers)) - 1:
+                # add the change made by the merged layers to the unmerged tokens
+                delta = hidden_states - merged_hidden_states
+                hidden_states = unmerged_hidden_states + torch.cat([delta[:, :1], merging.unmerge(delta[:, 1:], image_grid)], dim=1)
+                layer_attention_mask, layer_position_ids = attention_mask, position_ids
+                rotary_emb.seq_len_override = None
+
             if use_cache:
                 next_decoder_cache = layer_outputs[2 if output_attentions else 1]
 
             if output_attentions:
                 all_self_attns += (layer_outputs[1],)
 
+        if feature_states is not None and not skipped:
+            # the full forward ran, so every branch takes the fresh output, even the ones which could have skipped
+            for start, end, state in feature_states:
+                state["residual"] = hidden_states[start:end] - first_hidden_states[start:end]
+                self.feature_cache.record(state, skipped=False)
+
         hidden_states = self.norm(hidden_states)
 
         # add hidden states from the last decoder layer
@@ -1,8 +1,14 @@
+import os
+import json
+import hashlib
 import logging
+import weakref
+from collections import OrderedDict
 
 from PIL import Image
 import torch
 import numpy as np
+from safetensors.torch import load_file, save_file
 
 def create_logger(logging_dir):
     """
@@ -102,9 +108,228 @@ def vae_encode(vae, x, weight_dtype):
     return x
 
 def vae_encode_list(vae, x, weight_dtype):
-    latents = []
-    for img in x:
-        img = vae_encode(vae, img, weight_dtype)
-        latents.append(img)
+    # images of the same shape are encoded in one batch
+    latents = [None] * len(x)
+    shape_groups = {}
+    for i, img in enumerate(x):
+        if img is not None:
+            shape_groups.setdefault(tuple(img.shape), []).append(i)
+    for group in shape_groups.values():
+        batch_latents = vae_encode(vae, torch.cat([x[i] for i in group], dim=0), weight_dtype)
+        for i, latent in zip(group, batch_latents.split([x[i].size(0) for i in group], dim=0)):
+            latents[i] = latent
     return latents
 
+
+def tiled_apply(fn, x, tile_size, overlap, in_scale, out_scale, tile_batch_size=4):
+    """
+    Applies `fn` to overlapping tiles of `x` and blends the outputs with linear ramps over the overlaps.
+    `tile_size` and `overlap` are given in latent units, one latent unit is `in_scale` pixels of `x` and `out_scale` pixels of the output of `fn`.
+    The tiles of all images are processed `tile_batch_size` at a time, so the peak activation memory depends on the tile size instead of the resolution.
+    """
+    batch_size = x.size(0)
+    height, width = x.size(-2) // in_scale, x.size(-1) // in_scale
+    if height <= tile_size and width <= tile_size:
+        return fn(x)
+    tile_h, tile_w = min(tile_size, height), min(tile_size, width)
+
+    def tile_starts(length, tile):
+        stride = max(tile - overlap, 1)
+        return list(range(0, length - tile, stride)) + [length - tile]
+
+    def ramp(start, tile, length):
+        weight = torch.ones(tile * out_scale)
+        ramp_size = min(overlap, tile // 2) * out_scale
+        if ramp_size > 0:
+            up = torch.linspace(0, 1, ramp_size + 2)[1:-1]
+            if start > 0:
+                weight[:ramp_size] = up
+            if start + tile < length:
+                weight[-ramp_size:] = torch.minimum(weight[-ramp_size:], up.flip(0))
+        return weight
+
+    tiles = [(b_inx, top, left) for b_inx in range(batch_size) for top in tile_starts(height, tile_h) for left in tile_starts(width, tile_w)]
+    output, total_weight = None, None
+    for i in range(0, len(tiles), tile_batch_size):
+        batch_tiles = tiles[i: i+tile_batch_size]
+        inputs = torch.cat([x[b_inx:b_inx+1, :, top*in_scale: (top+tile_h)*in_scale, left*in_scale: (left+tile_w)*in_scale] for b_inx, top, left in batch_tiles], dim=0)
+        outputs = fn(inputs)
+        if output is None:
+            output = outputs.new_zeros(batch_size, outputs.size(1), height * out_scale, width * out_scale)
+            total_weight = outputs.new_zeros(1, 1, height * out_scale, width * out_scale)
+        for (b_inx, top, left), out in zip(batch_tiles, outputs):
+            weight = (ramp(top, tile_h, height)[:, None] * ramp(left, tile_w, width)[None, :]).to(out.device, out.dtype)
+            output[b_inx, :, top*out_scale: (top+tile_h)*out_scale, left*out_scale: (left+tile_w)*out_scale] += out * weight
+            if b_inx == 0:
+                total_weight[0, 0, top*out_scale: (top+tile_h)*out_scale, left*out_scale: (left+tile_w)*out_scale] += weight
+    return output / total_weight
+
+
+def tiled_vae_encode(vae, x, tile_size: int = 512, overlap: int = 64, tile_batch_size: int = 4):
+    """
+    Returns the latent moments (mean and logvar) of the images `x`, encoded in tiles of `tile_size` pixels.
+    """
+    return tiled_apply(lambda tile: vae.encode(tile).latent_dist.parameters, x, tile_size // 8, overlap // 8, 8, 1, tile_batch_size)
+
+
+def tiled_vae_decode(vae, z, tile_size: int = 512, overlap: int = 64, tile_batch_size: int = 4):
+    """
+    Decodes the (unscaled) latents `z` in tiles of `tile_size` pixels.
+    """
+    return tiled_apply(lambda tile: vae.decode(tile).sample, z, tile_size // 8, overlap // 8, 1, 8, tile_batch_size)
+
+
+# linear approximation of the SDXL VAE decoder, maps the 4 (scaled) latent channels to RGB
+LATENT_RGB_FACTORS = [
+    [ 0.3651,  0.4232,  0.4341],
+    [-0.2533, -0.0042,  0.1068],
+    [ 0.1076,  0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+
+def latent_to_rgb(latents, output_type: str = "pt"):
+    """
+    Cheap preview of the latents of the denoising loop (B, 4, H/8, W/8), without running the VAE decoder.
+    Returns a (B, 3, H/8, W/8) tensor in [0, 1], or a list of PIL images if output_type="pil".
+    """
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    bias = torch.tensor(LATENT_RGB_BIAS, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum("bchw,cr->brhw", latents.float(), factors) + bias[None, :, None, None]
+    rgb = ((rgb + 1) / 2).clamp(0, 1)
+    if output_type == "pt":
+        return rgb
+    rgb = (rgb * 255).to("cpu", dtype=torch.uint8).permute(0, 2, 3, 1).numpy()
+    return [Image.fromarray(x) for x in rgb]
+
+
+def image_digest(image):
+    """
+    Content hash of an input image, given as a file path or a PIL image.
+    """
+    hasher = hashlib.sha256()
+    if isinstance(image, Image.Image):
+        hasher.update(f"{image.mode}-{image.size}".encode())
+        hasher.update(image.tobytes())
+    else:
+        with open(image, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class OmniGenLatentCache:
+    """
+    LRU cache of the VAE latent distributions (mean and logvar) of input images, so repeated input images skip decoding, resizing and VAE encoding.
+    Entries are keyed by the content hash of the image, the max input image size, the identity of the VAE (its config and a fingerprint of its weights) and the VAE dtype.
+    At most `max_memory` bytes are kept in memory; if `cache_dir` is given, evicted entries are spilled there as safetensors files 
+    and read back into memory when they are requested again.
+    """
+    def __init__(self, max_memory: int = 1024 ** 3, cache_dir: str = None):
+        self.max_memory = max_memory
+        self.cache_dir = cache_dir
+        self.memory = 0
+        self.entries = OrderedDict()
+        # identity of each VAE seen so far, computed once per VAE
+        self.vae_ids = weakref.WeakKeyDictionary()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def vae_identity(self, vae) -> str:
+        "Hash of the VAE config and of a strided sample of every weight, so VAEs with the same config but different weights don't share entries"
+        if vae not in self.vae_ids:
+            hasher = hashlib.sha256(json.dumps(dict(vae.config), sort_keys=True, default=str).encode())
+            with torch.no_grad():
+                for name, tensor in vae.state_dict().items():
+                    values = tensor.flatten()
+                    sample = values[::max(1, values.numel() // 1024)].float().cpu().numpy()
+                    hasher.update(f"{name}-{tuple(tensor.shape)}".encode())
+                    hasher.update(sample.tobytes())
+            self.vae_ids[vae] = hasher.hexdigest()[:16]
+        return self.vae_ids[vae]
+
+    def make_key(self, image, max_image_size: int, vae) -> str:
+        return f"{image_digest(image)}-{max_image_size}-{self.vae_identity(vae)}-{str(vae.dtype).split('.')[-1]}"
+
+    def spill_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def get(self, key: str):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.cache_dir is not None and os.path.exists(self.spill_path(key)):
+            moments = load_file(self.spill_path(key))["moments"]
+            self.put(key, moments)
+            return moments
+        return None
+
+    def put(self, key: str, moments: torch.Tensor):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        # always copied, otherwise a CPU input or a view of a larger tensor keeps more bytes alive than the entry is charged for
+        moments = moments.detach().to("cpu").clone(memory_format=torch.contiguous_format)
+        size = moments.numel() * moments.element_size()
+        if size > self.max_memory:
+            if self.cache_dir is not None and not os.path.exists(self.spill_path(key)):
+                save_file({"moments": moments}, self.spill_path(key))
+            return
+        while self.memory + size > self.max_memory:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.memory -= evicted.numel() * evicted.element_size()
+            if self.cache_dir is not None and not os.path.exists(self.spill_path(evicted_key)):
+                save_file({"moments": evicted}, self.spill_path(evicted_key))
+        self.entries[key] = moments
+        self.memory += size
+
+    def clear(self):
+        self.entries.clear()
+        self.memory = 0
+
+
+class OmniGenResidency:
+    """
+    Remembers the placement (device, or a named mode like "offload") and the dtype each module of the pipeline was given, 
+    so repeated calls only move or cast the modules whose placement changed. The device and dtype of the first parameter are recorded too, 
+    and a module moved outside of the pipeline (e.g., `pipe.model.to("cpu")`) is placed again.
+    """
+    def __init__(self):
+        self.placements = {}
+
+    @staticmethod
+    def state_of(module):
+        param = next(module.parameters(), None)
+        return None if param is None else (param.device, param.dtype)
+
+    def place(self, name: str, module, device, dtype: torch.dtype = None, mode: str = None, move_fn=None) -> bool:
+        """
+        Moves `module` to `device` and casts its floating point weights to `dtype` (None keeps the current dtype), unless it is already there.
+        A custom placement is given by `mode` and applied by `move_fn(module, device, dtype)`. Returns whether the module was moved.
+        """
+        device = torch.device(device)
+        recorded = self.placements.get(name)
+        if recorded is not None and recorded[2] != self.state_of(module):
+            recorded = None
+        if dtype is None:
+            dtype = recorded[1] if recorded is not None else self.state_of(module)[1]
+        target = (mode or device, dtype)
+        if recorded is not None and recorded[:2] == target:
+            return False
+        if move_fn is None:
+            module.to(device=device, dtype=dtype)
+        else:
+            move_fn(module, device, dtype)
+        self.placements[name] = target + (self.state_of(module),)
+        return True
+
+    def invalidate(self, name: str = None):
+        "Forgets the placement of `name`, or of all the modules"
+        if name is None:
+            self.placements.clear()
+        else:
+            self.placements.pop(name, None)
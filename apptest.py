@@ -1,7 +1,10 @@
 import streamlit as st
 from OmniGen import OmniGenPipeline
+from OmniGen.utils import latent_to_rgb
+from OmniGen.scheduler import GenerationInterrupted
 from PIL import Image
 import os
+import time
 import zipfile
 
 def main():
@@ -40,17 +43,41 @@ def main():
     width = st.slider("Image Width:", min_value=256, max_value=2048, value=1920, step=64)
     guidance_scale = st.slider("Guidance Scale:", min_value=1.0, max_value=20.0, value=5.0, step=0.5)
     seed = st.number_input("Seed:", min_value=0, max_value=9999, value=111)
+    show_previews = st.checkbox("Show previews while generating", value=True)
+    time_limit = st.number_input("Time limit in seconds (0 for none):", min_value=0, max_value=3600, value=0)
 
     # Generate and display image
     if st.button("Generate Image"):
+        preview = st.empty()
+        # timed here, the cached pipeline is shared by every session so pipe.step_times may belong to another generation
+        step_ends = [time.monotonic()]
+
+        # cheap low resolution previews of the denoised estimate, stop the app to abort a bad generation early
+        def on_step(step, sigma, latents, denoised):
+            step_ends.append(time.monotonic())
+            if show_previews and step % 5 == 0:
+                preview.image(latent_to_rgb(denoised, output_type="pil")[0], caption=f"Step {step + 1}", use_column_width=True)
+
         with st.spinner("Generating image..."):
-            images = pipe(
-                prompt=prompt,
-                height=height,
-                width=width,
-                guidance_scale=guidance_scale,
-                seed=int(seed)
-            )
+            try:
+                images = pipe(
+                    prompt=prompt,
+                    height=height,
+                    width=width,
+                    guidance_scale=guidance_scale,
+                    seed=int(seed),
+                    callback=on_step,
+                    # past the limit, return the best estimate so far instead of failing
+                    timeout=time_limit if time_limit > 0 else None,
+                    on_interrupt="return",
+                )
+            except GenerationInterrupted as e:
+                # the limit was reached before the first step, there is no estimate to return
+                preview.empty()
+                st.error(str(e))
+                return
+            preview.empty()
+            st.caption(f"{len(step_ends) - 1} steps, {step_ends[-1] - step_ends[0]:.1f}s")
 
             # Display the generated image
             st.image(images[0], caption="Generated Image", use_column_width=True)